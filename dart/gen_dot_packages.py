@@ -8,6 +8,10 @@ import os
 import string
 import sys
 
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
 def parse_dot_packages(dot_packages_path):
   deps = {}
   with open(dot_packages_path) as dot_packages:
@@ -26,12 +30,6 @@ def parse_dot_packages(dot_packages_path):
   return deps
 
 
-def create_base_directory(file):
-  path = os.path.dirname(file)
-  if not os.path.exists(path):
-    os.makedirs(path)
-
-
 def main():
   parser = argparse.ArgumentParser(
       description="Generate .packages file for dart package")
@@ -46,7 +44,6 @@ def main():
   args = parser.parse_args()
 
   dot_packages_file = args.out
-  create_base_directory(dot_packages_file)
 
   package_deps = {
     args.package_name: args.source_dir,
@@ -63,11 +60,10 @@ def main():
       else:
         package_deps[name] = path
 
-  with open(dot_packages_file, "w") as dot_packages:
-    names = package_deps.keys()
-    names.sort()
-    for name in names:
-      dot_packages.write('%s:file://%s/\n' % (name, package_deps[name]))
+  names = package_deps.keys()
+  names.sort()
+  write_if_changed.write_file(dot_packages_file, ''.join(
+      '%s:file://%s/\n' % (name, package_deps[name]) for name in names))
 
   return 0
 
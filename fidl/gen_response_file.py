@@ -8,6 +8,10 @@ import os
 import string
 import sys
 
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
 
 def read_libraries(libraries_path):
     with open(libraries_path) as f:
@@ -16,13 +20,8 @@ def read_libraries(libraries_path):
 
 
 def write_libraries(libraries_path, libraries):
-    directory = os.path.dirname(libraries_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    with open(libraries_path, "w+") as f:
-        for library in libraries:
-            f.write(library)
-            f.write("\n")
+    write_if_changed.write_file(
+        libraries_path, "".join(library + "\n" for library in libraries))
 
 
 def main():
@@ -73,9 +72,8 @@ def main():
 
     response_file.extend(["--files %s" % library for library in target_libraries])
 
-    with open(args.out_response_file, "w+") as f:
-        f.write(" ".join(response_file))
-        f.write("\n")
+    write_if_changed.write_file(args.out_response_file,
+                                " ".join(response_file) + "\n")
 
 
 if __name__ == "__main__":
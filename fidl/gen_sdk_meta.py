@@ -8,6 +8,10 @@ import json
 import os
 import sys
 
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
 
 def main():
     parser = argparse.ArgumentParser('Builds a metadata file')
@@ -48,8 +52,7 @@ def main():
             raise Exception('Unsupported dependency type: %s' % type)
     metadata['deps'] = deps
 
-    with open(args.out, 'w') as out_file:
-        json.dump(metadata, out_file, indent=2, sort_keys=True)
+    write_if_changed.write_json(args.out, metadata)
 
     return 0
 
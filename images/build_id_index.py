@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+A compact, binary form of the `ids.txt` build ID map, for fast lookups.
+
+The file is a header, then a table of fixed-size entries sorted by build
+ID, then a pool of file name strings:
+
+    header:  magic (8 bytes), key_size (u32), count (u32)
+    entry:   key (key_size bytes: the build ID, zero-padded),
+             key_len (u16: the real length of the build ID),
+             name_offset (u32), name_size (u32): the file name in the pool
+
+All integers are little-endian.  Entries are sorted by the key bytes and
+then key_len, so a reader can mmap the file and binary-search it without
+parsing anything but the entries it touches.
+"""
+
+import argparse
+import binascii
+import mmap
+import os
+import struct
+import sys
+
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
+
+MAGIC = 'BUILDID\x01'
+HEADER = struct.Struct('<8sII')
+
+
+def entry_struct(key_size):
+    return struct.Struct('<%dsHII' % key_size)
+
+
+# Returns the bytes that entries are sorted by for the given build ID.
+def sort_key(build_id, key_size):
+    return build_id.ljust(key_size, '\0') + struct.pack('<H', len(build_id))
+
+
+def format_index(pairs):
+    """Return the index file contents for an iterable of (hex build ID,
+file name) pairs in sorted order, as in an ids.txt file.  Duplicate pairs
+are elided, but a build ID with two different file names is a ValueError."""
+    # Sorting the hex strings sorts the build IDs the same way the entries
+    # are sorted, so the pairs only need to be checked here.
+    unique_pairs = []
+    last = None
+    for pair in pairs:
+        if last is not None and pair <= last:
+            if pair == last:
+                continue
+            raise ValueError('build ID %s %s not in sorted order' % pair)
+        if last is not None and pair[0] == last[0]:
+            raise ValueError('build ID %s is both %s and %s' %
+                             (pair[0], last[1], pair[1]))
+        last = pair
+        unique_pairs.append((binascii.unhexlify(pair[0]), pair[1]))
+    pairs = unique_pairs
+    key_size = max([len(build_id) for build_id, filename in pairs] or [0])
+    entry = entry_struct(key_size)
+    entries = []
+    pool = []
+    pool_size = 0
+    for build_id, filename in pairs:
+        entries.append(entry.pack(build_id.ljust(key_size, '\0'),
+                                  len(build_id), pool_size, len(filename)))
+        pool.append(filename)
+        pool_size += len(filename)
+    return ''.join([HEADER.pack(MAGIC, key_size, len(entries))] +
+                   entries + pool)
+
+
+def write_index(filename, pairs):
+    """Write the index for sorted (hex build ID, file name) pairs to the file,
+unless it already has identical contents.  Returns True iff it was written."""
+    return write_if_changed.write_file(filename, format_index(pairs))
+
+
+# Yields (hex build ID, file name) pairs from an ids.txt file.
+def read_ids_txt(file):
+    for line in file:
+        build_id, filename = line.rstrip('\n').split(' ', 1)
+        yield build_id, filename
+
+
+class build_id_index(object):
+    """A reader for an index file, which it maps into memory.
+Use it in a `with` statement to unmap it at the end."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError('%s: not a build ID index' % filename)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_size, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s: not a build ID index' % filename)
+        self._entry = entry_struct(self.key_size)
+        self._pool = HEADER.size + self.count * self._entry.size
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, i):
+        pos = HEADER.size + i * self._entry.size
+        return self._map[pos:pos + self.key_size + 2]
+
+    def _pair(self, i):
+        key, key_len, name_offset, name_size = self._entry.unpack_from(
+            self._map, HEADER.size + i * self._entry.size)
+        name_offset += self._pool
+        return (binascii.hexlify(key[:key_len]),
+                self._map[name_offset:name_offset + name_size])
+
+    def lookup(self, build_id):
+        """Return the file name for the hex build ID, or None."""
+        try:
+            build_id = binascii.unhexlify(build_id)
+        except TypeError:
+            # Not a hex string, so not in any index.
+            return None
+        if len(build_id) > self.key_size:
+            return None
+        key = sort_key(build_id, self.key_size)
+        # Find the first entry not less than key.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            return self._pair(lo)[1]
+        return None
+
+    def __iter__(self):
+        """Yield (hex build ID, file name) pairs in sorted order."""
+        for i in xrange(self.count):
+            yield self._pair(i)
+
+
+# Module public API.
+__all__ = ['build_id_index', 'format_index', 'read_ids_txt', 'write_index']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+Convert ids.txt build ID maps to a binary index, or look up build IDs
+in an index.
+''')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        help='Write an index of the input ids.txt files')
+    parser.add_argument('--lookup',
+                        metavar='FILE',
+                        help='Print the file name for each build ID argument')
+    parser.add_argument('inputs', nargs='*',
+                        metavar='INPUT',
+                        help='ids.txt file, or build ID with --lookup')
+    args = parser.parse_args()
+    if bool(args.output) == bool(args.lookup):
+        parser.error('need exactly one of --output or --lookup')
+
+    if args.output:
+        pairs = []
+        for input in args.inputs:
+            with open(input, 'r') as file:
+                pairs.extend(read_ids_txt(file))
+        try:
+            write_index(args.output, sorted(pairs))
+        except ValueError as e:
+            sys.stderr.write('%s\n' % e)
+            return 1
+    else:
+        status = 0
+        with build_id_index(args.lookup) as index:
+            for build_id in args.inputs:
+                filename = index.lookup(build_id)
+                if filename is None:
+                    sys.stderr.write('%s: not found\n' % build_id)
+                    status = 1
+                else:
+                    print '%s %s' % (build_id, filename)
+        return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import StringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from build_id_index import (build_id_index, format_index, read_ids_txt,
+                            write_index)
+
+
+IDS_TXT = '''\
+01 lib/short.so
+0102 lib/prefix.so
+0a0b0c0d bin/app
+deadbeef00112233 lib/libc.so
+ff bin/last
+'''
+
+
+class BuildIdIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = os.path.join(self.dir, 'ids.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pairs(self):
+        return list(read_ids_txt(StringIO.StringIO(IDS_TXT)))
+
+    def test_round_trip(self):
+        self.assertTrue(write_index(self.index, self.pairs()))
+        with build_id_index(self.index) as index:
+            self.assertEqual(len(index), 5)
+            self.assertEqual(''.join('%s %s\n' % pair for pair in index),
+                             IDS_TXT)
+
+    def test_unchanged(self):
+        write_index(self.index, self.pairs())
+        self.assertFalse(write_index(self.index, self.pairs()))
+
+    def test_lookup(self):
+        write_index(self.index, self.pairs())
+        with build_id_index(self.index) as index:
+            for build_id, filename in self.pairs():
+                self.assertEqual(index.lookup(build_id), filename)
+            self.assertEqual(index.lookup('DEADBEEF00112233'), 'lib/libc.so')
+            for build_id in ['', '00', '010203', '0b', 'fe', 'ff00',
+                             '00112233445566778899', 'f', 'xyz']:
+                self.assertIsNone(index.lookup(build_id), build_id)
+
+    def test_duplicates(self):
+        pairs = self.pairs()
+        self.assertEqual(format_index(sorted(pairs + pairs)),
+                         format_index(pairs))
+        with self.assertRaises(ValueError):
+            format_index(sorted(pairs + [('01', 'lib/other.so')]))
+        with self.assertRaises(ValueError):
+            format_index(reversed(pairs))
+
+    def test_bad_magic(self):
+        contents = format_index(self.pairs())
+        for bad in ['BUILDID\x02' + contents[8:], 'MANIFST\x01' + contents[8:],
+                    contents[:4]]:
+            with open(self.index, 'wb') as f:
+                f.write(bad)
+            with self.assertRaises(ValueError):
+                build_id_index(self.index)
+
+
+if __name__ == '__main__':
+    unittest.main()
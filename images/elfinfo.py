@@ -5,9 +5,23 @@
 
 from contextlib import contextmanager
 from collections import namedtuple
+from file_copy import COPY_CHUNK_SIZE, copy_range, write_all
+import atexit
+import errno
+import hashlib
+import itertools
+import json
 import mmap
 import os
+import stat_cache
 import struct
+import tracing
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # Standard ELF constants.
@@ -31,6 +45,32 @@ DT_STRTAB = 5
 DT_SONAME = 14
 NT_GNU_BUILD_ID = 3
 SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+SHF_COMPRESSED = 0x800
+ELFCOMPRESS_ZLIB = 1
+ELFCOMPRESS_ZSTD = 2
+
+# DWARF 5 line table content type codes.
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+
+# DWARF attribute form codes that can appear in a line table header.
+DW_FORM_block2 = 0x03
+DW_FORM_block4 = 0x04
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_string = 0x08
+DW_FORM_block = 0x09
+DW_FORM_block1 = 0x0a
+DW_FORM_data1 = 0x0b
+DW_FORM_sdata = 0x0d
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_data16 = 0x1e
+DW_FORM_line_strp = 0x1f
+
 
 
 class elf_note(
@@ -134,6 +174,16 @@ def gen_elf():
             ('sh_addralign', 'Q'),
             ('sh_entsize', 'Q'),
         ]),
+        'Chdr': ([
+            ('ch_type', 'L'),
+            ('ch_size', 'L'),
+            ('ch_addralign', 'L'),
+        ], [
+            ('ch_type', 'L'),
+            ('ch_reserved', 'L'),
+            ('ch_size', 'Q'),
+            ('ch_addralign', 'Q'),
+        ]),
         'Dyn': ([
             ('d_tag', 'i'),
             ('d_val', 'I'),
@@ -146,45 +196,37 @@ def gen_elf():
             ('n_descsz', 'I'),
             ('n_type', 'I'),
         ],
-        'dwarf2_line_header': [
-            ('unit_length', 'L'),
-            ('version', 'H'),
-            ('header_length', 'L'),
-            ('minimum_instruction_length', 'B'),
-            ('default_is_stmt', 'B'),
-            ('line_base', 'b'),
-            ('line_range', 'B'),
-            ('opcode_base', 'B'),
-        ],
-        'dwarf4_line_header': [
-            ('unit_length', 'L'),
-            ('version', 'H'),
-            ('header_length', 'L'),
-            ('minimum_instruction_length', 'B'),
-            ('maximum_operations_per_instruction', 'B'),
-            ('default_is_stmt', 'B'),
-            ('line_base', 'b'),
-            ('line_range', 'b'),
-            ('opcode_base', 'B'),
-        ],
     }
 
     # There is an accessor for each struct, e.g. Ehdr.
     # Ehdr.read is a function like Struct.unpack_from.
+    # Ehdr.read_table is like Ehdr.read but decodes an array of `count`
+    # structs in one go, yielding an elf_table.
     # Ehdr.size is the size of the struct.
     elf_accessor = namedtuple('elf_accessor',
-                              ['size', 'read', 'write', 'pack'])
+                              ['size', 'read', 'read_table', 'write', 'pack'])
 
     # All the accessors for a format (class, byte-order) form one elf,
     # e.g. use elf.Ehdr and elf.Phdr.
     elf = namedtuple('elf', elf_types.keys())
 
     def gen_accessors(is64, struct_byte_order):
-        def make_accessor(type, decoder):
+        def make_accessor(type, decoder, fmt):
+            # A whole table is decoded by a single Struct that repeats
+            # the format `count` times.  These are cached by count.
+            table_decoders = {}
+            def table_decoder(count):
+                table = table_decoders.get(count)
+                if table is None:
+                    table = struct.Struct(struct_byte_order + fmt * count)
+                    table_decoders[count] = table
+                return table
             return elf_accessor(
                 size=decoder.size,
                 read=lambda buffer, offset=0: type._make(
-                    decoder.unpack_from(buffer, offset)),
+                    unpack_from(decoder, buffer, offset)),
+                read_table=lambda buffer, offset, count: elf_table(
+                    type, unpack_from(table_decoder(count), buffer, offset)),
                 write=lambda buffer, offset, x: decoder.pack_into(
                     buffer, offset, *x),
                 pack=lambda x: decoder.pack(*x))
@@ -192,9 +234,9 @@ def gen_elf():
             if isinstance(fields, tuple):
                 fields = fields[1 if is64 else 0]
             type = namedtuple(name, [field_name for field_name, fmt in fields])
-            decoder = struct.Struct(struct_byte_order +
-                                    ''.join(fmt for field_name, fmt in fields))
-            yield make_accessor(type, decoder)
+            fmt = ''.join(fmt for field_name, fmt in fields)
+            decoder = struct.Struct(struct_byte_order + fmt)
+            yield make_accessor(type, decoder, fmt)
 
     for elfclass, is64 in [(ELFCLASS32, False), (ELFCLASS64, True)]:
         for elf_bo, struct_bo in [(ELFDATA2LSB, '<'), (ELFDATA2MSB, '>')]:
@@ -204,6 +246,12 @@ def gen_elf():
 # e.g. ELF[file[EI_CLASS], file[EI_DATA]].Ehdr.read(file).e_phnum
 ELF = dict(gen_elf())
 
+def unpack_from(decoder, buffer, offset=0):
+    # A pread_file reads just the bytes it's asked for.
+    if isinstance(buffer, pread_file):
+        return buffer.unpack_from(decoder, offset)
+    return decoder.unpack_from(buffer, offset)
+
 def get_elf_accessor(file):
     # If it looks like an ELF file, whip out the decoder ring.
     if file[:len(ELFMAG)] == ELFMAG:
@@ -211,6 +259,52 @@ def get_elf_accessor(file):
     return None
 
 
+class elf_table(object):
+    """An array of decoded ELF structs, stored as one flat tuple of values.
+
+Callers filter on columns, e.g. `phdrs.where('p_type', PT_LOAD)`, so a
+namedtuple is only made for each row that's actually wanted."""
+
+    def __init__(self, type, values):
+        self.type = type
+        self.values = values
+        self.width = len(type._fields)
+
+    def __len__(self):
+        return len(self.values) // self.width
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('elf_table index out of range')
+        return self.type._make(
+            self.values[index * self.width:(index + 1) * self.width])
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def column(self, field):
+        """Return a tuple of all the rows' values for the named field."""
+        return self.values[self.type._fields.index(field)::self.width]
+
+    def where(self, field, value):
+        """Return a list of the rows whose named field equals value."""
+        return [self[index]
+                for index, x in enumerate(self.column(field))
+                if x == value]
+
+
+def read_phdrs(file, elf, ehdr):
+    return elf.Phdr.read_table(file, ehdr.e_phoff, ehdr.e_phnum)
+
+
+def read_shdrs(file, elf, ehdr):
+    return elf.Shdr.read_table(file, ehdr.e_shoff, ehdr.e_shnum)
+
+
+# These decode one struct at a time, for comparison in test_main_bench.
 def gen_phdrs(file, elf, ehdr):
   for pos in xrange(0, ehdr.e_phnum * elf.Phdr.size, elf.Phdr.size):
       yield elf.Phdr.read(file, ehdr.e_phoff + pos)
@@ -250,6 +344,7 @@ This ensures that the mmap and file objects are closed at the end of the
             fileobj.close()
     else:
         mmapobj = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        tracing.add_counter('bytes mapped', len(mmapobj))
         try:
             yield fd, mmapobj
         finally:
@@ -257,6 +352,115 @@ This ensures that the mmap and file objects are closed at the end of the
             fileobj.close()
 
 
+# The size of each positioned read when searching for a string terminator.
+FIND_CHUNK_SIZE = 256
+
+# The size of the initial read of a file, which usually covers the ELF
+# header and the program headers.
+HEADER_READ_SIZE = 4096
+
+
+class pread_file(object):
+    """A read-only, string-like view of a file that only reads what is used.
+
+Slices, single-byte indexing, `find` and `unpack_from` are supported.  Each
+access is a positioned read of just the bytes needed, except that ranges
+passed to `prefetch` are read in one go and then served from memory."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.bytes_read = 0
+        self._regions = []
+        self.prefetch(0, HEADER_READ_SIZE)
+
+    def __len__(self):
+        return self.size
+
+    def pread(self, size, offset):
+        size = max(0, min(size, self.size - offset))
+        chunks = []
+        while size > 0:
+            if hasattr(os, 'pread'):
+                chunk = os.pread(self.fd, size, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                chunk = os.read(self.fd, size)
+            if not chunk:
+                break
+            self.bytes_read += len(chunk)
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    # Returns (data, base) for a cached region covering [start, stop),
+    # or (None, None).
+    def _region(self, start, stop):
+        for base, data in self._regions:
+            if base <= start and stop <= base + len(data):
+                return data, base
+        return None, None
+
+    def prefetch(self, offset, size):
+        """Read the given range now; later accesses within it are free."""
+        if self._region(offset, offset + size)[0] is None:
+            data = self.pread(size, offset)
+            self._regions.append((offset, data))
+            return data, offset
+        return self._region(offset, offset + size)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self.size
+            if index < 0 or index >= self.size:
+                raise IndexError('pread_file index out of range')
+            return self[index:index + 1]
+        start, stop, step = index.indices(self.size)
+        assert step == 1, "pread_file does not support extended slices"
+        if stop <= start:
+            return ''
+        data, base = self._region(start, stop)
+        if data is None:
+            return self.pread(stop - start, start)
+        return data[start - base:stop - base]
+
+    def unpack_from(self, decoder, offset=0):
+        data, base = self._region(offset, offset + decoder.size)
+        if data is None:
+            data, base = self.pread(decoder.size, offset), offset
+        return decoder.unpack_from(data, offset - base)
+
+    def find(self, sub, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        pos = start
+        while pos < end:
+            data, base = self._region(pos, pos + len(sub))
+            if data is None:
+                data, base = self.prefetch(pos, FIND_CHUNK_SIZE)
+            limit = min(end, base + len(data))
+            found = data.find(sub, pos - base, limit - base)
+            if found >= 0:
+                return base + found
+            if limit >= end:
+                break
+            # Back up so a match straddling the chunk boundary is found.
+            pos = limit - len(sub) + 1
+        return -1
+
+
+@contextmanager
+def preader(filename):
+    """A context manager that yields (fd, pread_file) given a file name."""
+    with open(filename, 'rb') as fileobj:
+        file = pread_file(fileobj.fileno())
+        try:
+            yield fileobj.fileno(), file
+        finally:
+            tracing.add_counter('bytes read', file.bytes_read)
+
+
 # elf_info objects are only created by `get_elf_info` or the `copy` or
 # `rename` methods.
 class elf_info(
@@ -289,153 +493,555 @@ class elf_info(
     def get_sources(self):
         raise Exception("uninitialized elf_info object!")
 
+    def load_size(self):
+        """Return the total p_memsz of the PT_LOAD segments, which is how
+much address space loading the file maps."""
+        with preader(self.filename) as read:
+            fd, file = read
+            ehdr = self.elf.Ehdr.read(file)
+            size = sum(phdr.p_memsz
+                       for phdr in read_phdrs(file, self.elf, ehdr)
+                       .where('p_type', PT_LOAD))
+        # Replace the method to just return the cached size next time.
+        self.load_size = lambda: size
+        return size
+
     def strip(self, stripped_filename):
         """Write stripped output to the given file unless it already exists
-with identical contents.  Returns True iff the file was changed."""
-        with mmapper(self.filename) as mapped:
-            fd, file = mapped
+with identical contents.  Returns True iff the file was changed.
+
+A sidecar file (see strip_digest) records a digest of the stripped contents
+and the identities of the input and output files, so an existing output is
+checked without reading it back.  The output is written to a temporary
+file, with the body copied in the kernel where possible, and then renamed
+into place."""
+        digest_filename = stripped_filename + '.digest'
+        with preader(self.filename) as read:
+            fd, file = read
             ehdr = self.elf.Ehdr.read(file)
 
             stripped_ehdr = ehdr._replace(e_shoff=0, e_shnum=0, e_shstrndx=0)
             stripped_size = max(phdr.p_offset + phdr.p_filesz
-                                for phdr in gen_phdrs(file, self.elf, ehdr)
-                                if phdr.p_type == PT_LOAD)
+                                for phdr in read_phdrs(file, self.elf, ehdr)
+                                .where('p_type', PT_LOAD))
             assert ehdr.e_phoff + (ehdr.e_phnum *
                                    ehdr.e_phentsize) <= stripped_size
+            header = self.elf.Ehdr.pack(stripped_ehdr)
+
+            source_key = list(stat_cache.stat_key(os.fstat(fd)))
+            try:
+                output_key = list(stat_cache.file_key(stripped_filename))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                output_key = None
+            old = read_strip_digest(digest_filename)
+            if old is not None and old.output != output_key:
+                # The output is missing or was changed behind our back.
+                old = None
+
+            # If neither file has changed since last time, we're done.
+            if old is not None and old.source == source_key:
+                return False
 
             def gen_stripped_contents():
-                yield self.elf.Ehdr.pack(stripped_ehdr)
-                yield file[self.elf.Ehdr.size:stripped_size]
-
-            def old_file_matches():
-                old_size = os.path.getsize(stripped_filename)
-                new_size = sum(len(x) for x in gen_stripped_contents())
-                if old_size != new_size:
-                    return False
+                yield header
+                for offset in xrange(self.elf.Ehdr.size, stripped_size,
+                                     COPY_CHUNK_SIZE):
+                    yield file.pread(min(COPY_CHUNK_SIZE,
+                                         stripped_size - offset), offset)
+            digest = content_digest(gen_stripped_contents())
+
+            if old is None and output_key is not None:
+                # There's no (valid) sidecar, so read the old output once.
                 with open(stripped_filename, 'rb') as f:
-                    for chunk in gen_stripped_contents():
-                        if f.read(len(chunk)) != chunk:
-                            return False
-                return True
+                    old_digest = content_digest(
+                        iter(lambda: f.read(COPY_CHUNK_SIZE), ''))
+                old = strip_digest(old_digest, None, output_key)
 
-            if os.path.exists(stripped_filename):
-                if old_file_matches():
-                    return False
-                else:
-                    os.remove(stripped_filename)
+            if old is not None and old.digest == digest:
+                # The input changed, but not in the parts that are kept.
+                write_strip_digest(digest_filename,
+                                   old._replace(source=source_key))
+                return False
 
             # Create the new file with the same mode as the original.
-            with os.fdopen(os.open(stripped_filename,
-                                   os.O_WRONLY | os.O_CREAT | os.O_EXCL,
-                                   os.fstat(fd).st_mode & 0777),
-                           'wb') as stripped_file:
-                stripped_file.write(self.elf.Ehdr.pack(stripped_ehdr))
-                stripped_file.write(file[self.elf.Ehdr.size:stripped_size])
+            with temp_output(stripped_filename,
+                             os.fstat(fd).st_mode & 0777) as out_fd:
+                write_all(out_fd, header)
+                copy_range(fd, out_fd, self.elf.Ehdr.size,
+                           stripped_size - self.elf.Ehdr.size)
+            write_strip_digest(digest_filename, strip_digest(
+                digest, source_key,
+                list(stat_cache.file_key(stripped_filename))))
             return True
 
-def get_elf_info(filename, match_notes=False):
-    file = None
-    elf = None
-    ehdr = None
-    phdrs = None
 
-    # Yields an elf_note for each note in any PT_NOTE segment.
-    def gen_notes():
-        def round_up_to(size):
-            return ((size + 3) / 4) * 4
-        for phdr in phdrs:
-            if phdr.p_type == PT_NOTE:
-                pos = phdr.p_offset
-                while pos < phdr.p_offset + phdr.p_filesz:
-                    nhdr = elf.Nhdr.read(file, pos)
-                    pos += elf.Nhdr.size
-                    name = file[pos:pos + nhdr.n_namesz]
-                    pos += round_up_to(nhdr.n_namesz)
-                    desc = file[pos:pos + nhdr.n_descsz]
-                    pos += round_up_to(nhdr.n_descsz)
-                    yield elf_note(name, nhdr.n_type, desc)
-
-    def gen_sections():
-        shdrs = list(gen_shdrs(file, elf, ehdr))
+    def compress_debug_sections(self, output_filename, compression='zlib'):
+        """Write a copy of the file with each .debug_* section compressed
+(SHF_COMPRESSED) with `compression`, either 'zlib' or 'zstd'.
+
+Everything the segments or the allocated sections cover is copied as is.
+The other sections after that are laid out again, followed by the section
+header table.  The output is written to a temporary file and then renamed
+into place, so a file by that name is always complete."""
+        ch_type, compressor = get_debug_compressor(compression)
+        with preader(self.filename) as read:
+            fd, file = read
+            reader = elf_reader(self.filename, file)
+            elf = reader.elf
+            ehdr = reader.ehdr
+            assert ehdr.e_shentsize == elf.Shdr.size, (
+                "%s: invalid e_shentsize" % self.filename)
+            shdrs = list(reader.shdrs)
+            section_name = reader.section_namer()
+            # The compression header and the section header table both
+            # need word alignment.
+            align = 8 if ehdr.e_ident[EI_CLASS] == chr(ELFCLASS64) else 4
+
+            # Find how much of the file must stay where it is.
+            fixed_size = max([elf.Ehdr.size,
+                              ehdr.e_phoff + ehdr.e_phnum * ehdr.e_phentsize] +
+                             [phdr.p_offset + phdr.p_filesz
+                              for phdr in reader.phdrs] +
+                             [shdr.sh_offset + shdr.sh_size
+                              for shdr in shdrs[1:]
+                              if (shdr.sh_flags & SHF_ALLOC and
+                                  shdr.sh_type != SHT_NOBITS)])
+            order = sorted(xrange(1, len(shdrs)),
+                           key=lambda i: shdrs[i].sh_offset)
+            for i in order:
+                shdr = shdrs[i]
+                if (shdr.sh_offset < fixed_size and
+                    shdr.sh_type != SHT_NOBITS):
+                    fixed_size = max(fixed_size,
+                                     shdr.sh_offset + shdr.sh_size)
+
+            with temp_output(output_filename,
+                             os.fstat(fd).st_mode & 0777) as out_fd:
+                copy_range(fd, out_fd, 0, fixed_size)
+                pos = fixed_size
+                def pad_to(alignment):
+                    padding = -pos % max(alignment, 1)
+                    write_all(out_fd, '\0' * padding)
+                    return pos + padding
+                for i in order:
+                    shdr = shdrs[i]
+                    if shdr.sh_offset < fixed_size:
+                        continue
+                    if shdr.sh_type == SHT_NOBITS:
+                        shdrs[i] = shdr._replace(sh_offset=pos)
+                        continue
+                    if (shdr.sh_size == 0 or
+                        shdr.sh_flags & SHF_COMPRESSED or
+                        not section_name(shdr.sh_name).startswith('.debug_')):
+                        pos = pad_to(shdr.sh_addralign)
+                        copy_range(fd, out_fd, shdr.sh_offset, shdr.sh_size)
+                        shdrs[i] = shdr._replace(sh_offset=pos)
+                        pos += shdr.sh_size
+                        continue
+                    pos = pad_to(align)
+                    chdr = elf.Chdr.read('\0' * elf.Chdr.size)._replace(
+                        ch_type=ch_type,
+                        ch_size=shdr.sh_size,
+                        ch_addralign=shdr.sh_addralign)
+                    size = elf.Chdr.size
+                    write_all(out_fd, elf.Chdr.pack(chdr))
+                    compress = compressor()
+                    for offset in xrange(shdr.sh_offset,
+                                         shdr.sh_offset + shdr.sh_size,
+                                         COPY_CHUNK_SIZE):
+                        data = compress.compress(file.pread(
+                            min(COPY_CHUNK_SIZE,
+                                shdr.sh_offset + shdr.sh_size - offset),
+                            offset))
+                        write_all(out_fd, data)
+                        size += len(data)
+                    data = compress.flush()
+                    write_all(out_fd, data)
+                    size += len(data)
+                    shdrs[i] = shdr._replace(
+                        sh_offset=pos, sh_size=size,
+                        sh_flags=shdr.sh_flags | SHF_COMPRESSED,
+                        sh_addralign=align)
+                    pos += size
+                pos = pad_to(align)
+                write_all(out_fd, ''.join(elf.Shdr.pack(shdr)
+                                          for shdr in shdrs))
+                os.lseek(out_fd, 0, os.SEEK_SET)
+                write_all(out_fd, elf.Ehdr.pack(ehdr._replace(e_shoff=pos)))
+
+
+@contextmanager
+def temp_output(filename, mode):
+    """A context manager that yields a file descriptor for writing a new
+`filename`.  It's written under a temporary name and renamed into place
+when the body finishes, or removed if the body raises."""
+    tmp = stat_cache.temp_filename(filename)
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+        os.rename(tmp, filename)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+# This is the contents of the sidecar file that elf_info.strip writes next
+# to a stripped file: a digest of the stripped file's contents and the
+# stat_cache.stat_key lists of the input and output files.
+strip_digest = namedtuple('strip_digest', ['digest', 'source', 'output'])
+
+def read_strip_digest(filename):
+    try:
+        with open(filename, 'r') as f:
+            return strip_digest(**json.load(f))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except (ValueError, TypeError):
+        # Garbage in the sidecar just means we can't trust it.
+        pass
+    return None
+
+def write_strip_digest(filename, digest):
+    stat_cache.replace_file(filename, json.dumps(digest._asdict(),
+                                                 sort_keys=True) + '\n')
+
+
+def content_digest(chunks):
+    hash = hashlib.sha256()
+    for chunk in chunks:
+        hash.update(chunk)
+    return hash.hexdigest()
+
+
+# Returns the ELFCOMPRESS_* type for the named compression and a function
+# that returns a new object with the compress and flush methods of
+# zlib.compressobj.  zstd needs the optional `zstandard` module.
+def get_debug_compressor(compression):
+    if compression == 'zlib':
+        return ELFCOMPRESS_ZLIB, zlib.compressobj
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard module')
+        return (ELFCOMPRESS_ZSTD,
+                lambda: zstandard.ZstdCompressor().compressobj())
+    raise ValueError('unknown compression %r' % compression)
+
+
+# Returns the uncompressed contents of an SHF_COMPRESSED section.
+def decompress_section(elf, file, shdr, filename):
+    chdr = elf.Chdr.read(file, shdr.sh_offset)
+    data = file[shdr.sh_offset + elf.Chdr.size:shdr.sh_offset + shdr.sh_size]
+    if chdr.ch_type == ELFCOMPRESS_ZLIB:
+        data = zlib.decompress(data)
+    elif chdr.ch_type == ELFCOMPRESS_ZSTD and zstandard is not None:
+        data = zstandard.ZstdDecompressor().decompress(
+            data, max_output_size=chdr.ch_size)
+    else:
+        raise ValueError('%s: unsupported section compression type %u' %
+                         (filename, chdr.ch_type))
+    assert len(data) == chdr.ch_size, (
+        "%s: compressed section has the wrong size" % filename)
+    return data
+
+
+# Returns the subset of `notes` selected by `match_notes`, which is either
+# a bool (all or nothing) or an iterable of ident pairs.
+def filter_notes(notes, match_notes):
+    if isinstance(match_notes, bool):
+        if match_notes:
+            return list(notes)
+        else:
+            return []
+    return [note for note in notes if note.ident() in match_notes]
+
+
+class dwarf_data(object):
+    """A cursor decoding DWARF data from a string-like buffer.
+
+The primitive decoders advance `pos`.  ULEB128 sequences are decoded in
+bulk from one bytearray, with a fast path for the common 1-byte values."""
+
+    # Fixed-size integer formats by byte size.
+    FIXED_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    # Forms whose values are just skipped over, by byte size.
+    FIXED_FORMS = {
+        DW_FORM_data1: 1,
+        DW_FORM_data2: 2,
+        DW_FORM_data4: 4,
+        DW_FORM_data8: 8,
+        DW_FORM_data16: 16,
+    }
+
+    def __init__(self, buffer, base, struct_bo, filename, pos=0):
+        self.buffer = buffer
+        self.base = base
+        self.struct_bo = struct_bo
+        self.filename = filename
+        self.pos = pos
+        self._bytes = None
+
+    def fixed(self, size, count=None):
+        """Decode one unsigned integer of `size` bytes, or a tuple of
+`count` of them."""
+        n = 1 if count is None else count
+        values = struct.unpack_from(
+            self.struct_bo + self.FIXED_FORMATS[size] * n,
+            self.buffer, self.base + self.pos)
+        self.pos += size * n
+        return values[0] if count is None else values
+
+    def ulebs(self, count):
+        """Decode a list of `count` ULEB128 values."""
+        if self._bytes is None:
+            self._bytes = bytearray(self.buffer)
+        data = self._bytes
+        pos = self.base + self.pos
+        values = []
+        for i in xrange(count):
+            byte = data[pos]
+            pos += 1
+            value = byte & 0x7f
+            shift = 7
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+            values.append(value)
+        self.pos = pos - self.base
+        return values
+
+    def uleb(self):
+        return self.ulebs(1)[0]
+
+    def sleb(self):
+        start = self.pos
+        value = self.uleb()
+        bits = 7 * (self.pos - start)
+        if value & (1 << (bits - 1)):
+            value -= 1 << bits
+        return value
+
+    def string(self):
+        """Decode a '\\0'-terminated string."""
+        start = self.base + self.pos
+        end = self.buffer.find('\0', start)
+        assert end >= start, (
+            "%s: Unterminated string in DWARF data" % self.filename)
+        self.pos = end + 1 - self.base
+        return self.buffer[start:end]
+
+    def gen_strings(self):
+        """Generate strings until an empty string."""
+        while True:
+            string = self.string()
+            if not string:
+                break
+            yield string
+
+    def form(self, form, offset_size):
+        """Decode a value of the given DW_FORM_* code.  The value of a
+DW_FORM_strp or DW_FORM_line_strp is the offset into its string section."""
+        if form == DW_FORM_string:
+            return self.string()
+        if form in (DW_FORM_line_strp, DW_FORM_strp):
+            return self.fixed(offset_size)
+        if form == DW_FORM_udata:
+            return self.uleb()
+        if form == DW_FORM_sdata:
+            return self.sleb()
+        size = self.FIXED_FORMS.get(form)
+        if size in self.FIXED_FORMATS:
+            return self.fixed(size)
+        if size is None:
+            if form == DW_FORM_block:
+                size = self.uleb()
+            elif form in (DW_FORM_block1, DW_FORM_block2, DW_FORM_block4):
+                size = self.fixed({DW_FORM_block1: 1,
+                                   DW_FORM_block2: 2,
+                                   DW_FORM_block4: 4}[form])
+            else:
+                raise Exception("%s: unsupported DWARF form %#x in "
+                                ".debug_line" % (self.filename, form))
+        start = self.base + self.pos
+        self.pos += size
+        return self.buffer[start:start + size]
+
+
+class lazy_property(object):
+    """A decorator for a method that computes an attribute on first use."""
+
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        value = self.method(obj)
+        # Shadow this descriptor with the value in the instance.
+        setattr(obj, self.method.__name__, value)
+        return value
+
+
+class elf_reader(object):
+    """Decodes the parts of an ELF file that are actually used.
+
+`file` is a string-like object, such as a pread_file or an mmap.  Each
+attribute is computed on first use and reads only the parts of the file
+it needs: e.g. `stripped` reads just the section headers and their name
+strings, never the section contents."""
+
+    def __init__(self, filename, file):
+        self.filename = filename
+        self.file = file
+        # This is None if it's not an ELF file at all.
+        self.elf = get_elf_accessor(file)
+
+    def prefetch(self, offset, size):
+        if isinstance(self.file, pread_file):
+            self.file.prefetch(offset, size)
+
+    @lazy_property
+    def ehdr(self):
+        ehdr = self.elf.Ehdr.read(self.file)
+        # A relocatable file has no program headers, so no e_phentsize.
+        assert ehdr.e_phnum == 0 or ehdr.e_phentsize == self.elf.Phdr.size, (
+            "%s: invalid e_phentsize" % self.filename)
+        return ehdr
+
+    @lazy_property
+    def phdrs(self):
+        self.prefetch(self.ehdr.e_phoff, self.ehdr.e_phnum * self.elf.Phdr.size)
+        return read_phdrs(self.file, self.elf, self.ehdr)
+
+    @lazy_property
+    def shdrs(self):
+        self.prefetch(self.ehdr.e_shoff, self.ehdr.e_shnum * self.elf.Shdr.size)
+        return read_shdrs(self.file, self.elf, self.ehdr)
+
+    # Returns a function from sh_name to the section name string.
+    def section_namer(self):
+        strtab_shdr = self.shdrs[self.ehdr.e_shstrndx]
+        strtab = self.file[strtab_shdr.sh_offset:
+                           strtab_shdr.sh_offset + strtab_shdr.sh_size]
+        def section_name(sh_name):
+            assert sh_name < len(strtab), (
+                "%s: invalid sh_name" % self.filename)
+            end = strtab.find('\0', sh_name)
+            assert end >= sh_name, (
+                "%s: Unterminated string at %#x" %
+                (self.filename, strtab_shdr.sh_offset + sh_name))
+            return strtab[sh_name:end]
+        return section_name
+
+    # Yields (shdr, name) for each section but the null section.
+    def gen_sections(self):
+        shdrs = self.shdrs
         if not shdrs:
             return
-        strtab_shdr = shdrs[ehdr.e_shstrndx]
-        for shdr, i in zip(shdrs, xrange(len(shdrs))):
-            if i == 0:
-                continue
-            assert shdr.sh_name < strtab_shdr.sh_size, (
-                "%s: invalid sh_name" % filename)
-            yield (shdr,
-                   extract_C_string(strtab_shdr.sh_offset + shdr.sh_name))
+        section_name = self.section_namer()
+        for shdr in itertools.islice(shdrs, 1, None):
+            yield shdr, section_name(shdr.sh_name)
 
     # Generates '\0'-terminated strings starting at the given offset,
     # until an empty string.
-    def gen_strings(start):
+    def gen_strings(self, start):
         while True:
-            end = file.find('\0', start)
+            end = self.file.find('\0', start)
             assert end >= start, (
-                "%s: Unterminated string at %#x" % (filename, start))
+                "%s: Unterminated string at %#x" % (self.filename, start))
             if start == end:
                 break
-            yield file[start:end]
+            yield self.file[start:end]
             start = end + 1
 
-    def extract_C_string(start):
-        for string in gen_strings(start):
+    def extract_C_string(self, start):
+        for string in self.gen_strings(start):
             return string
         return ''
 
-    # Returns a string of hex digits (or None).
-    def get_build_id():
+    # Yields an elf_note for each note in any PT_NOTE segment.
+    def gen_notes(self):
+        def round_up_to(size):
+            return ((size + 3) / 4) * 4
+        file = self.file
+        elf = self.elf
+        for phdr in self.phdrs.where('p_type', PT_NOTE):
+            self.prefetch(phdr.p_offset, phdr.p_filesz)
+            pos = phdr.p_offset
+            while pos < phdr.p_offset + phdr.p_filesz:
+                nhdr = elf.Nhdr.read(file, pos)
+                pos += elf.Nhdr.size
+                name = file[pos:pos + nhdr.n_namesz]
+                pos += round_up_to(nhdr.n_namesz)
+                desc = file[pos:pos + nhdr.n_descsz]
+                pos += round_up_to(nhdr.n_descsz)
+                yield elf_note(name, nhdr.n_type, desc)
+
+    @lazy_property
+    def notes(self):
+        """A list of all the elf_note objects."""
+        return list(self.gen_notes())
+
+    @lazy_property
+    def build_id(self):
+        """A string of hex digits (or None)."""
         build_id = None
-        for note in gen_notes():
+        for note in self.notes:
             # Note that the last build_id note needs to be used due to TO-442.
             possible_build_id = note.build_id_hex()
             if possible_build_id:
                 build_id = possible_build_id
         return build_id
 
-    # Returns a list of elf_note objects.
-    def get_matching_notes():
-        if isinstance(match_notes, bool):
-            if match_notes:
-                return list(gen_notes())
-            else:
-                return []
-        # If not a bool, it's an iterable of ident pairs.
-        return [note for note in gen_notes() if note.ident() in match_notes]
-
-    # Returns a string (without trailing '\0'), or None.
-    def get_interp():
+    @lazy_property
+    def interp(self):
+        """A string (without trailing '\\0'), or None."""
         # PT_INTERP points directly to a string in the file.
-        for interp in (phdr for phdr in phdrs if phdr.p_type == PT_INTERP):
-            interp = file[interp.p_offset:interp.p_offset + interp.p_filesz]
+        for interp in self.phdrs.where('p_type', PT_INTERP):
+            interp = self.file[interp.p_offset:
+                               interp.p_offset + interp.p_filesz]
             if interp[-1:] == '\0':
                 interp = interp[:-1]
             return interp
         return None
 
-    # Returns a set of strings.
-    def get_soname_and_needed():
+    @lazy_property
+    def soname_and_needed(self):
+        """A pair of DT_SONAME string (or None) and set of DT_NEEDED strings."""
+        file = self.file
+        elf = self.elf
+        phdrs = self.phdrs
+
         # Each DT_NEEDED or DT_SONAME points to a string in the .dynstr table.
         def GenDTStrings(tag):
-            return (extract_C_string(strtab_offset + dt.d_val)
-                    for dt in dyn if dt.d_tag == tag)
+            return (self.extract_C_string(strtab_offset + d_val)
+                    for d_tag, d_val in dt_columns if d_tag == tag)
 
         # PT_DYNAMIC points to the list of ElfNN_Dyn tags.
-        for dynamic in (phdr for phdr in phdrs if phdr.p_type == PT_DYNAMIC):
-            dyn = [elf.Dyn.read(file, dynamic.p_offset + dyn_offset)
-                   for dyn_offset in xrange(0, dynamic.p_filesz, elf.Dyn.size)]
+        for dynamic in phdrs.where('p_type', PT_DYNAMIC):
+            self.prefetch(dynamic.p_offset, dynamic.p_filesz)
+            dyn = elf.Dyn.read_table(file, dynamic.p_offset,
+                                     dynamic.p_filesz // elf.Dyn.size)
+            dt_columns = zip(dyn.column('d_tag'), dyn.column('d_val'))
 
             # DT_STRTAB points to the string table's vaddr (.dynstr).
-            [strtab_vaddr] = [dt.d_val for dt in dyn if dt.d_tag == DT_STRTAB]
+            [strtab_vaddr] = [d_val for d_tag, d_val in dt_columns
+                              if d_tag == DT_STRTAB]
 
             # Find the PT_LOAD containing the vaddr to compute the file offset.
             [strtab_offset] = [
                 strtab_vaddr - phdr.p_vaddr + phdr.p_offset
-                for phdr in phdrs
-                if (phdr.p_type == PT_LOAD and
-                    phdr.p_vaddr <= strtab_vaddr and
+                for phdr in phdrs.where('p_type', PT_LOAD)
+                if (phdr.p_vaddr <= strtab_vaddr and
                     strtab_vaddr - phdr.p_vaddr < phdr.p_filesz)
             ]
 
@@ -446,119 +1052,333 @@ def get_elf_info(filename, match_notes=False):
             return soname, set(GenDTStrings(DT_NEEDED))
         return None, set()
 
-    def get_stripped():
-        return all(
-            shdr.sh_type != SHT_SYMTAB and not name.startswith('.debug_')
-            for shdr, name in gen_sections())
-
-    def get_cpu():
-        return ELF_MACHINE_TO_CPU.get(ehdr.e_machine)
-
-    def gen_source_files():
-        # Given the file position of a CU header (starting with the
-        # beginning of the .debug_line section), return the position
-        # of the include_directories portion and the position of the
-        # next CU header.
-        def read_line_header(pos):
-                # Decode DWARF .debug_line per-CU header.
-                hdr_type = elf.dwarf2_line_header
-                hdr = hdr_type.read(file, pos)
-                assert hdr.unit_length < 0xfffffff0, (
-                    "%s: 64-bit DWARF" % filename)
-                assert hdr.version in [2,3,4], (
-                    "%s: DWARF .debug_line version %r" %
-                    (filename, hdr.version))
-                if hdr.version == 4:
-                    hdr_type = elf.dwarf4_line_header
-                    hdr = hdr_type.read(file, pos)
-                return (pos + hdr_type.size + hdr.opcode_base - 1,
-                        pos + 4 + hdr.unit_length)
-
-        # Decode include_directories portion of DWARF .debug_line format.
-        def read_include_dirs(pos):
-            include_dirs = list(gen_strings(pos))
-            pos += sum(len(dir) + 1 for dir in include_dirs) + 1
-            return pos, include_dirs
-
-        # Decode file_paths portion of DWARF .debug_line format.
-        def gen_file_paths(start, limit):
-            while start < limit:
-                end = file.find('\0', start, limit)
+    @lazy_property
+    def stripped(self):
+        """True iff there are no symbols or .debug_* sections."""
+        shdrs = self.shdrs
+        if not shdrs:
+            return True
+        if SHT_SYMTAB in shdrs.column('sh_type')[1:]:
+            return False
+        section_name = self.section_namer()
+        return not any(section_name(sh_name).startswith('.debug_')
+                       for sh_name in shdrs.column('sh_name')[1:])
+
+    # Returns the uncompressed size of the section.
+    def section_size(self, shdr):
+        if shdr.sh_flags & SHF_COMPRESSED:
+            return self.elf.Chdr.read(self.file, shdr.sh_offset).ch_size
+        return shdr.sh_size
+
+    # Returns (buffer, offset) where the section's contents can be read.
+    # An SHF_COMPRESSED section is decompressed into a string.
+    def section_contents(self, shdr):
+        if shdr.sh_flags & SHF_COMPRESSED:
+            return decompress_section(self.elf, self.file, shdr,
+                                      self.filename), 0
+        return self.file, shdr.sh_offset
+
+    @lazy_property
+    def cpu(self):
+        return ELF_MACHINE_TO_CPU.get(self.ehdr.e_machine)
+
+    def gen_source_files(self):
+        file = self.file
+        filename = self.filename
+        struct_bo = '<' if file[EI_DATA] == chr(ELFDATA2LSB) else '>'
+        sections = dict((name, shdr) for shdr, name in self.gen_sections())
+
+        # DW_FORM_line_strp and DW_FORM_strp refer to these sections.
+        def string_section_reader(name):
+            shdr = sections.get(name)
+            contents = []
+            def read_string(offset):
+                assert shdr and offset < self.section_size(shdr), (
+                    "%s: invalid %s offset %#x" % (filename, name, offset))
+                if not contents:
+                    contents.extend(self.section_contents(shdr))
+                buffer, base = contents
+                start = base + offset
+                end = buffer.find('\0', start)
                 assert end >= start, (
                     "%s: Unterminated string at %#x" % (filename, start))
-                if start == end:
+                return buffer[start:end]
+            return read_string
+        string_readers = {
+            DW_FORM_line_strp: string_section_reader('.debug_line_str'),
+            DW_FORM_strp: string_section_reader('.debug_str'),
+        }
+
+        # Decode one CU's .debug_line header starting at `start`, and
+        # return the position of the next CU header and a generator of
+        # file names.
+        def read_line_header(file, start):
+            data = dwarf_data(file, start, struct_bo, filename)
+            unit_length = data.fixed(4)
+            if unit_length == 0xffffffff:
+                # 64-bit DWARF format.
+                offset_size = 8
+                unit_length = data.fixed(8)
+            else:
+                offset_size = 4
+                assert unit_length < 0xfffffff0, (
+                    "%s: invalid .debug_line unit_length %#x" %
+                    (filename, unit_length))
+            next = start + data.pos + unit_length
+            version = data.fixed(2)
+            assert version in [2, 3, 4, 5], (
+                "%s: DWARF .debug_line version %r" % (filename, version))
+            if version >= 5:
+                address_size, segment_selector_size = data.fixed(1, 2)
+            header_length = data.fixed(offset_size)
+            program_start = start + data.pos + header_length
+            assert program_start <= next, (
+                "%s: invalid .debug_line header_length" % filename)
+            # Now the whole header is known to be in bounds, decode
+            # the rest from one copy of it.
+            data = dwarf_data(file[start:program_start], 0, struct_bo,
+                              filename, data.pos)
+            if version >= 4:
+                (minimum_instruction_length,
+                 maximum_operations_per_instruction,
+                 default_is_stmt, line_base, line_range,
+                 opcode_base) = data.fixed(1, 6)
+            else:
+                (minimum_instruction_length,
+                 default_is_stmt, line_base, line_range,
+                 opcode_base) = data.fixed(1, 5)
+            # Skip standard_opcode_lengths.
+            data.pos += opcode_base - 1
+
+            if version < 5:
+                return next, gen_v2_file_names(data)
+            return next, gen_v5_file_names(data, offset_size)
+
+        # Before DWARF 5, include_directories is a list of strings, and
+        # file_names is a list of (string, ULEB128 directory index, ULEB128
+        # mtime, ULEB128 length) tuples, each list ending with an empty
+        # string.  Directory index 0 means DW_AT_comp_dir, which should be
+        # ".", and indices into the actual table start at 1.
+        def gen_v2_file_names(data):
+            include_dirs = [''] + list(data.gen_strings())
+            while True:
+                name = data.string()
+                if not name:
                     break
-                name = file[start:end]
-                start = end + 1
-                # Decode 3 ULEB128s to advance start, but only use the first.
-                for i in range(3):
-                    value = 0
-                    bits = 0
-                    while start < limit:
-                        byte = ord(file[start])
-                        start += 1
-                        value |= (byte & 0x7f) << bits
-                        if (byte & 0x80) == 0:
-                            break
-                        bits += 7
-                    if i == 0:
-                        include_idx = value
-                # Ignore the fake file names the compiler leaks into the DWARF.
-                if name not in ['<stdin>', '<command-line>']:
-                    yield name, include_idx
-
-        for shdr, name in gen_sections():
+                [dir_index, mtime, length] = data.ulebs(3)
+                yield include_dirs[dir_index], name
+
+        # In DWARF 5, each of the directories and file_names tables is
+        # preceded by a description of the format of its entries: a list
+        # of (content type, form) pairs.  Directory 0 is DW_AT_comp_dir
+        # and file 0 is the primary source file.
+        def gen_v5_entries(data, offset_size):
+            formats = data.ulebs(2 * data.fixed(1))
+            formats = zip(formats[0::2], formats[1::2])
+            for i in xrange(data.uleb()):
+                entry = {}
+                for content_type, form in formats:
+                    value = data.form(form, offset_size)
+                    if form in string_readers:
+                        value = string_readers[form](value)
+                    entry[content_type] = value
+                yield entry
+
+        def gen_v5_file_names(data, offset_size):
+            include_dirs = [entry.get(DW_LNCT_path, '')
+                            for entry in gen_v5_entries(data, offset_size)]
+            # 0 means DW_AT_comp_dir, which should be ".".
+            if include_dirs:
+                include_dirs[0] = ''
+            for entry in gen_v5_entries(data, offset_size):
+                yield (include_dirs[entry.get(DW_LNCT_directory_index, 0)],
+                       entry[DW_LNCT_path])
+
+        for shdr, name in self.gen_sections():
             if name == '.debug_line':
-                next = shdr.sh_offset
-                while next < shdr.sh_offset + shdr.sh_size:
-                    pos, next = read_line_header(next)
-
-                    pos, include_dirs = read_include_dirs(pos)
-                    assert pos <= next
-
-                    # 0 means relative to DW_AT_comp_dir, which should be ".".
-                    # Indices into the actual table start at 1.
-                    include_dirs.insert(0, '')
-
-                    # Decode file_paths and apply include directories.
-                    for name, i in gen_file_paths(pos, next):
-                        name = os.path.join(include_dirs[i], name)
-                        yield os.path.normpath(name)
-
+                buffer, next = self.section_contents(shdr)
+                end = next + self.section_size(shdr)
+                while next < end:
+                    next, file_names = read_line_header(buffer, next)
+                    for dir, name in file_names:
+                        # Ignore the fake file names the compiler leaks
+                        # into the DWARF.
+                        if name not in ['<stdin>', '<command-line>']:
+                            yield os.path.normpath(os.path.join(dir, name))
+
+
+def read_elf_info(filename, match_notes=False):
     # This closure becomes the elf_info object's `get_sources` method.
     def lazy_get_sources():
-        # Run the generator and cache its results as a set.
-        sources_cache = set(gen_source_files())
+        # Map in the whole file, since .debug_line is decoded in bulk.
+        with mmapper(filename) as mapped:
+            fd, file = mapped
+            # Run the generator and cache its results as a set.
+            sources_cache = set(elf_reader(filename, file).gen_source_files())
         # Replace the method to just return the cached set next time.
         info.get_sources = lambda: sources_cache
         return sources_cache
 
-    # Map in the whole file's contents and use it as a string.
-    with mmapper(filename) as mapped:
-        fd, file = mapped
-        elf = get_elf_accessor(file)
-        if elf is not None:
-            # ELF header leads to program headers.
-            ehdr = elf.Ehdr.read(file)
-            assert ehdr.e_phentsize == elf.Phdr.size, (
-                "%s: invalid e_phentsize" % filename)
-            phdrs = list(gen_phdrs(file, elf, ehdr))
+    # Read just the headers and the small parts of the file they point to.
+    with preader(filename) as read:
+        fd, file = read
+        reader = elf_reader(filename, file)
+        if reader.elf is not None:
             info = elf_info(filename,
-                            get_cpu(),
-                            get_matching_notes(),
-                            get_build_id(),
-                            get_stripped(),
-                            get_interp(),
-                            *get_soname_and_needed())
-            info.elf = elf
+                            reader.cpu,
+                            filter_notes(reader.notes, match_notes),
+                            reader.build_id,
+                            reader.stripped,
+                            reader.interp,
+                            *reader.soname_and_needed)
+            info.elf = reader.elf
             info.get_sources = lazy_get_sources
             return info
 
     return None
 
 
+# When enabled, this is a stat_cache.stat_cache of elf_info records.
+_cache = None
+
+def enable_cache(filename):
+    """Make get_elf_info use a persistent cache in the given file.
+The cache is saved when the process exits."""
+    global _cache
+    if _cache is None:
+        _cache = stat_cache.stat_cache(filename, ELF_RECORD_VERSION)
+        atexit.register(_cache.save)
+    return _cache
+
+
+# The cache stores a plain tuple for each file: None for a non-ELF file, or
+# (ident, e_machine, notes, build_id, stripped, interp, soname, needed)
+# where ident is the (EI_CLASS, EI_DATA) pair selecting the ELF accessor,
+# and notes are (name, type, desc) tuples for all the notes.  Bump this
+# whenever that changes.
+ELF_RECORD_VERSION = 1
+
+def make_elf_record(filename):
+    return elf_record(read_elf_info(filename, True))
+
+
+def elf_record(info):
+    """Return the plain tuple form of an elf_info (or None), which
+elf_info_from_record turns back into an elf_info."""
+    if info is None:
+        return None
+    [ident] = [ident for ident, elf in ELF.iteritems() if elf is info.elf]
+    return (ident,
+            info.cpu and info.cpu.e_machine,
+            [tuple(note) for note in info.notes],
+            info.build_id,
+            info.stripped,
+            info.interp,
+            info.soname,
+            sorted(info.needed))
+
+
+def elf_info_from_record(filename, record, match_notes):
+    """Return an elf_info for the file from its elf_record."""
+    if record is None:
+        return None
+    ident, e_machine, notes, build_id, stripped, interp, soname, needed = record
+
+    # The sources are only available by actually reading the file.
+    def lazy_get_sources():
+        sources = read_elf_info(filename).get_sources()
+        info.get_sources = lambda: sources
+        return sources
+
+    info = elf_info(filename,
+                    ELF_MACHINE_TO_CPU.get(e_machine),
+                    filter_notes((elf_note(*note) for note in notes),
+                                 match_notes),
+                    build_id,
+                    stripped,
+                    interp,
+                    soname,
+                    set(needed))
+    info.elf = ELF[ident]
+    info.get_sources = lazy_get_sources
+    return info
+
+
+def get_elf_info(filename, match_notes=False):
+    """Return an elf_info for the file, or None if it's not an ELF file.
+`match_notes` is True for all notes, False for none, or an iterable of
+note ident pairs to select."""
+    if _cache is None:
+        return read_elf_info(filename, match_notes)
+    return elf_info_from_record(filename,
+                                _cache.get(filename, make_elf_record),
+                                match_notes)
+
+
+# Yields the name of each regular file under `dir`, not following symlinks.
+def gen_tree_files(dir):
+    for dirpath, dirnames, filenames in os.walk(dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filename = os.path.join(dirpath, filename)
+            if not os.path.islink(filename):
+                yield filename
+
+
+def scan_elf_file(filename):
+    """Return a dict of details about an ELF file, for JSON output, or None
+if it's not an ELF file.  Only the first few bytes of a non-ELF file are
+read.  Errors are reported in the dict rather than raised, so one odd file
+doesn't stop a scan of a whole tree."""
+    try:
+        with open(filename, 'rb') as fileobj:
+            if fileobj.read(len(ELFMAG)) != ELFMAG:
+                return None
+            file = pread_file(fileobj.fileno())
+            reader = elf_reader(filename, file)
+            soname, needed = reader.soname_and_needed
+            return {
+                'filename': filename,
+                'cpu': reader.cpu and reader.cpu.gn,
+                'build_id': reader.build_id,
+                'soname': soname,
+                'needed': sorted(needed),
+                'interp': reader.interp,
+                'stripped': reader.stripped,
+                'size': file.size,
+                'segments': [{'flags': phdr.p_flags,
+                              'filesz': phdr.p_filesz,
+                              'memsz': phdr.p_memsz}
+                             for phdr in reader.phdrs.where('p_type',
+                                                            PT_LOAD)],
+            }
+    except (AssertionError, EnvironmentError, KeyError, ValueError,
+            struct.error) as e:
+        return {'filename': filename, 'error': str(e)}
+
+
+def scan_tree(dir, jobs):
+    """Yield a scan_elf_file dict for each ELF file under `dir`, reading
+files in `jobs` processes.  The results come in no particular order."""
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(scan_elf_file, gen_tree_files(dir),
+                                          chunksize=64):
+            if result is not None:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 # Module public API.
-__all__ = ['cpu', 'elf_info', 'elf_note', 'get_elf_accessor', 'get_elf_info']
+__all__ = ['cpu', 'elf_info', 'elf_info_from_record', 'elf_note', 'elf_reader',
+           'elf_record', 'enable_cache', 'get_elf_accessor', 'get_elf_info',
+           'mmapper', 'preader', 'scan_elf_file', 'scan_tree']
 
 
 def test_main_strip(filenames):
@@ -572,6 +1392,17 @@ def test_main_strip(filenames):
                                   os.stat(stripped_filename).st_size)
 
 
+def test_main_compress(compression, filenames):
+    for filename in filenames:
+        info = get_elf_info(filename)
+        print info
+        compressed_filename = info.filename + '.ei-' + compression
+        info.compress_debug_sections(compressed_filename, compression)
+        print '\t%s: %u -> %u' % (compressed_filename,
+                                  os.stat(filename).st_size,
+                                  os.stat(compressed_filename).st_size)
+
+
 def test_main_get_info(filenames):
     for filename in filenames:
         info = get_elf_info(filename)
@@ -580,10 +1411,100 @@ def test_main_get_info(filenames):
             print '\t' + source
 
 
-# For manual testing.
+def test_main_depfile(depfile, target, filenames):
+    # Write a depfile saying `target` depends on all the sources of the
+    # given files, e.g. for a stripped output of those files.
+    sources = set()
+    for filename in filenames:
+        sources.update(get_elf_info(filename).get_sources())
+    with open(depfile, 'w') as f:
+        f.write(target + ':' + ''.join(' ' + source
+                                       for source in sorted(sources)) + '\n')
+
+
+def test_main_bench(filenames, repeat=100):
+    # Compare decoding the Phdr, Shdr and Dyn tables one struct at a time
+    # with decoding each whole table in one go.
+    import timeit
+    with_tables = 0
+    one_by_one = 0
+    for filename in filenames:
+        with mmapper(filename) as mapped:
+            fd, file = mapped
+            elf = get_elf_accessor(file)
+            if elf is None:
+                continue
+            ehdr = elf.Ehdr.read(file)
+            dynamic = read_phdrs(file, elf, ehdr).where('p_type', PT_DYNAMIC)
+            def decode_one_by_one():
+                list(gen_phdrs(file, elf, ehdr))
+                list(gen_shdrs(file, elf, ehdr))
+                for phdr in dynamic:
+                    [elf.Dyn.read(file, phdr.p_offset + pos)
+                     for pos in xrange(0, phdr.p_filesz, elf.Dyn.size)]
+            def decode_tables():
+                read_phdrs(file, elf, ehdr).column('p_type')
+                read_shdrs(file, elf, ehdr).column('sh_type')
+                for phdr in dynamic:
+                    elf.Dyn.read_table(file, phdr.p_offset,
+                                       phdr.p_filesz // elf.Dyn.size
+                                       ).column('d_tag')
+            old = timeit.timeit(decode_one_by_one, number=repeat)
+            new = timeit.timeit(decode_tables, number=repeat)
+            print '%s: %u phdrs, %u shdrs: %.1fus -> %.1fus (%.1fx)' % (
+                filename, ehdr.e_phnum, ehdr.e_shnum,
+                old * 1e6 / repeat, new * 1e6 / repeat, old / new)
+            one_by_one += old
+            with_tables += new
+    if with_tables:
+        print 'Total: %.3fs -> %.3fs (%.1fx)' % (
+            one_by_one, with_tables, one_by_one / with_tables)
+
+
+def scan_main(argv):
+    import argparse
+    import multiprocessing
+    import sys
+    parser = argparse.ArgumentParser(
+        prog='elfinfo.py -scan',
+        description='Write a JSON line describing each ELF file in a tree.')
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=multiprocessing.cpu_count(),
+                        metavar='N',
+                        help='Read files in N processes')
+    parser.add_argument('--output', '-o',
+                        metavar='FILE',
+                        help='Output file (default: stdout)')
+    parser.add_argument('dir', nargs='+',
+                        help='Directory to scan')
+    args = parser.parse_args(argv)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for dir in args.dir:
+            for result in scan_tree(dir, args.jobs):
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+# For manual testing, and `elfinfo.py -scan DIR...` to survey a build.
 if __name__ == "__main__":
     import sys
-    if sys.argv[1] == '-strip':
+    if sys.argv[1] == '-cache':
+        cache = enable_cache(sys.argv[2])
+        for filename in sys.argv[3:]:
+            print get_elf_info(filename)
+        print cache.stats()
+    elif sys.argv[1] == '-scan':
+        scan_main(sys.argv[2:])
+    elif sys.argv[1] == '-depfile':
+        test_main_depfile(sys.argv[2], sys.argv[3], sys.argv[4:])
+    elif sys.argv[1] == '-bench':
+        test_main_bench(sys.argv[2:])
+    elif sys.argv[1] == '-strip':
         test_main_strip(sys.argv[2:])
+    elif sys.argv[1] == '-compress':
+        test_main_compress(sys.argv[2], sys.argv[3:])
     else:
         test_main_get_info(sys.argv[1:])
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from elfinfo import (DW_FORM_block1, DW_FORM_data1, DW_FORM_data16,
+                     DW_FORM_line_strp, DW_FORM_sdata, DW_FORM_string,
+                     DW_FORM_strp, DW_FORM_udata, DW_LNCT_directory_index,
+                     DW_LNCT_path, dwarf_data, elf_reader, read_elf_info)
+import elfinfo
+
+
+ELF64 = elfinfo.ELF[chr(elfinfo.ELFCLASS64), chr(elfinfo.ELFDATA2LSB)]
+ET_REL = 1
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+DW_LNCT_MD5 = 5
+OPCODE_BASE = 13
+
+
+# Returns the contents of a relocatable ELF file with the given sections,
+# a list of (name, contents) pairs.
+def make_elf(sections):
+    sections = sections + [('.shstrtab', None)]
+    shstrtab = '\0' + ''.join(name + '\0' for name, contents in sections)
+    contents = ''
+    shdrs = [ELF64.Shdr.pack((0,) * 10)]
+    for name, data in sections:
+        sh_type = SHT_PROGBITS
+        if data is None:
+            data, sh_type = shstrtab, SHT_STRTAB
+        shdrs.append(ELF64.Shdr.pack((
+            shstrtab.index('\0' + name + '\0') + 1, sh_type, 0, 0,
+            ELF64.Ehdr.size + len(contents), len(data), 0, 0, 1, 0)))
+        contents += data
+    ident = (elfinfo.ELFMAG + chr(elfinfo.ELFCLASS64) +
+             chr(elfinfo.ELFDATA2LSB) + '\1').ljust(16, '\0')
+    ehdr = ELF64.Ehdr.pack((ident, ET_REL, elfinfo.EM_X86_64, 1, 0, 0,
+                            ELF64.Ehdr.size + len(contents), 0,
+                            ELF64.Ehdr.size, 0, 0, ELF64.Shdr.size,
+                            len(shdrs), len(sections)))
+    return ehdr + contents + ''.join(shdrs)
+
+
+def uleb(value):
+    data = ''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data += chr(byte | 0x80)
+        else:
+            return data + chr(byte)
+
+
+def offset(value, offset_size):
+    return struct.pack('<I' if offset_size == 4 else '<Q', value)
+
+
+# Returns a .debug_line unit with the given header fields after
+# opcode_base, and a line number program that is just skipped over.
+def line_unit(version, offset_size, tables, program='\0\1\1'):
+    header = struct.pack('<BBbBB', 1, 1, -5, 14, OPCODE_BASE)
+    if version >= 4:
+        # maximum_operations_per_instruction
+        header = header[:1] + '\1' + header[1:]
+    header += '\0' * (OPCODE_BASE - 1) + tables
+    unit = struct.pack('<H', version)
+    if version >= 5:
+        # address_size, segment_selector_size
+        unit += '\x08\x00'
+    unit += offset(len(header), offset_size) + header + program
+    if offset_size == 4:
+        return struct.pack('<I', len(unit)) + unit
+    return struct.pack('<IQ', 0xffffffff, len(unit)) + unit
+
+
+# Returns the include_directories and file_names tables before DWARF 5.
+def v2_tables():
+    return ('include\0' '/abs/dir\0' '\0' +
+            'main.c\0' + uleb(0) + uleb(300) + uleb(1234) +
+            'foo.h\0' + uleb(1) + uleb(0) + uleb(0) +
+            'bar.h\0' + uleb(2) + uleb(0) + uleb(0) +
+            '<stdin>\0' + uleb(0) + uleb(0) + uleb(0) +
+            '\0')
+
+
+# Returns a string pool and a function from a string to its offset in it.
+def string_pool(strings):
+    pool = ''.join(string + '\0' for string in strings)
+    return pool, lambda string: pool.index(string + '\0')
+
+
+# Returns DWARF 5 directories and file_names tables with the directory
+# names in .debug_line_str and the file names in .debug_str.
+def v5_tables(offset_size, line_str, debug_str):
+    tables = '\1' + uleb(DW_LNCT_path) + uleb(DW_FORM_line_strp)
+    tables += uleb(3) + ''.join(offset(line_str(dir), offset_size)
+                                for dir in ['/comp/dir', 'include',
+                                            '/abs/dir'])
+    tables += ('\3' +
+               uleb(DW_LNCT_path) + uleb(DW_FORM_strp) +
+               uleb(DW_LNCT_directory_index) + uleb(DW_FORM_udata) +
+               uleb(DW_LNCT_MD5) + uleb(DW_FORM_data16))
+    tables += uleb(3) + ''.join(
+        offset(debug_str(name), offset_size) + uleb(dir) + '\xaa' * 16
+        for name, dir in [('main.c', 0), ('foo.h', 1), ('bar.h', 2)])
+    return tables
+
+
+EXPECTED_SOURCES = set(['main.c', 'include/foo.h', '/abs/dir/bar.h'])
+
+
+class DwarfDataTests(unittest.TestCase):
+
+    def test_leb128(self):
+        data = dwarf_data('x' + uleb(5) + uleb(300) + uleb(1 << 40) +
+                          '\x7f\x80\x7f\x02',
+                          1, '<', 'test')
+        self.assertEqual(data.ulebs(2), [5, 300])
+        self.assertEqual(data.uleb(), 1 << 40)
+        self.assertEqual(data.sleb(), -1)
+        self.assertEqual(data.sleb(), -128)
+        self.assertEqual(data.sleb(), 2)
+        self.assertEqual(data.pos, 1 + 2 + 6 + 4)
+
+    def test_forms(self):
+        data = dwarf_data('abc\0' '\x01\x02\x03\x04' '\x05' '\x7e'
+                          '\x02\x01\x02' + '\x09' * 16,
+                          0, '<', 'test')
+        self.assertEqual(data.form(DW_FORM_string, 4), 'abc')
+        self.assertEqual(data.form(DW_FORM_line_strp, 4), 0x04030201)
+        self.assertEqual(data.form(DW_FORM_udata, 4), 5)
+        self.assertEqual(data.form(DW_FORM_sdata, 4), -2)
+        self.assertEqual(data.form(DW_FORM_block1, 4), '\x01\x02')
+        self.assertEqual(data.form(DW_FORM_data16, 4), '\x09' * 16)
+
+    def test_strings(self):
+        data = dwarf_data('a\0bc\0\0d\0', 0, '<', 'test')
+        self.assertEqual(list(data.gen_strings()), ['a', 'bc'])
+        self.assertEqual(data.string(), 'd')
+
+
+class SourcesTests(unittest.TestCase):
+
+    # Returns the source files that elf_reader finds in the sections.
+    def sources(self, sections):
+        contents = make_elf(sections)
+        return set(elf_reader('test', contents).gen_source_files())
+
+    def v5_sections(self, offset_size):
+        line_str, line_str_offset = string_pool(['', '/comp/dir', 'include',
+                                                 '/abs/dir'])
+        debug_str, debug_str_offset = string_pool(['', 'bar.h', 'foo.h',
+                                                   'main.c'])
+        return [
+            ('.debug_line', line_unit(5, offset_size,
+                                      v5_tables(offset_size, line_str_offset,
+                                                debug_str_offset))),
+            ('.debug_line_str', line_str),
+            ('.debug_str', debug_str),
+        ]
+
+    def test_dwarf4(self):
+        self.assertEqual(
+            self.sources([('.debug_line', line_unit(4, 4, v2_tables()))]),
+            EXPECTED_SOURCES)
+
+    def test_dwarf3_64bit(self):
+        self.assertEqual(
+            self.sources([('.debug_line', line_unit(3, 8, v2_tables()))]),
+            EXPECTED_SOURCES)
+
+    def test_dwarf5(self):
+        # Directory 0 is the compilation directory, so main.c is relative.
+        self.assertEqual(self.sources(self.v5_sections(4)), EXPECTED_SOURCES)
+
+    def test_dwarf5_64bit(self):
+        self.assertEqual(self.sources(self.v5_sections(8)), EXPECTED_SOURCES)
+
+    def test_dwarf5_inline_strings(self):
+        tables = ('\1' + uleb(DW_LNCT_path) + uleb(DW_FORM_string) +
+                  uleb(2) + '/comp/dir\0' 'sub/dir\0' +
+                  '\2' + uleb(DW_LNCT_path) + uleb(DW_FORM_string) +
+                  uleb(DW_LNCT_directory_index) + uleb(DW_FORM_data1) +
+                  uleb(2) + 'a.c\0' '\0' 'b.h\0' '\1')
+        self.assertEqual(
+            self.sources([('.debug_line', line_unit(5, 4, tables))]),
+            set(['a.c', 'sub/dir/b.h']))
+
+    def test_multiple_units(self):
+        sections = self.v5_sections(8)
+        sections[0] = ('.debug_line',
+                       line_unit(4, 4, v2_tables().replace('main.c', 'x.c'),
+                                 program='\0' * 100) +
+                       sections[0][1] +
+                       line_unit(2, 4, '\0' 'y.c\0' '\0\0\0' '\0'))
+        self.assertEqual(self.sources(sections),
+                         EXPECTED_SOURCES | set(['x.c', 'y.c']))
+
+    def test_no_debug_line(self):
+        self.assertEqual(self.sources([('.text', '\xc3')]), set())
+
+    def test_get_sources(self):
+        dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(dir, 'test.o')
+            with open(filename, 'wb') as f:
+                f.write(make_elf(self.v5_sections(4)))
+            info = read_elf_info(filename)
+            self.assertFalse(info.stripped)
+            self.assertEqual(info.get_sources(), EXPECTED_SOURCES)
+        finally:
+            shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Low-level ways to copy file data: in the kernel with copy_file_range or
+sendfile where possible, as a reflink, or as a hard link.
+"""
+
+import errno
+import fcntl
+import os
+
+
+# The chunk size for copying or hashing file contents in Python.
+COPY_CHUNK_SIZE = 1 << 20
+
+# The Linux ioctl that makes a file share another's blocks (a reflink).
+FICLONE = 0x40049409
+
+# A method failing with one of these errors means it doesn't work for this
+# file system or these files, so a caller can try another one.
+COPY_FALLBACK_ERRNOS = frozenset([
+    errno.EINVAL,
+    errno.EMLINK,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+])
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def copy_range(in_fd, out_fd, offset, size):
+    """Copy `size` bytes at `offset` in in_fd to out_fd's current position.
+This uses copy_file_range or sendfile so the data never enters Python when
+they are available and work on these files; otherwise it reads and writes
+in bounded chunks."""
+    def copy_file_range(count):
+        return os.copy_file_range(in_fd, out_fd, count, offset)
+    def sendfile(count):
+        return os.sendfile(out_fd, in_fd, offset, count)
+    def read_write(count):
+        os.lseek(in_fd, offset, os.SEEK_SET)
+        data = os.read(in_fd, min(count, COPY_CHUNK_SIZE))
+        write_all(out_fd, data)
+        return len(data)
+    methods = [method for name, method in [
+        ('copy_file_range', copy_file_range),
+        ('sendfile', sendfile),
+    ] if hasattr(os, name)] + [read_write]
+    while size > 0:
+        try:
+            copied = methods[0](size)
+        except OSError as e:
+            # The kernel can refuse these for some file systems.
+            if len(methods) == 1 or e.errno not in (errno.EINVAL,
+                                                    errno.ENOSYS,
+                                                    errno.EXDEV,
+                                                    errno.EOPNOTSUPP):
+                raise
+            methods.pop(0)
+            continue
+        if copied == 0:
+            raise IOError(errno.EIO, 'Unexpected end of file')
+        offset += copied
+        size -= copied
+
+
+def link_file(source, dest):
+    os.link(source, dest)
+
+
+def create_copy(dest):
+    return os.fdopen(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0666), 'wb')
+
+
+def clone_file(source, dest):
+    with open(source, 'rb') as src, create_copy(dest) as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_file(source, dest):
+    with open(source, 'rb') as src, create_copy(dest) as dst:
+        copy_range(src.fileno(), dst.fileno(), 0,
+                   os.fstat(src.fileno()).st_size)
+
+
+# Module public API.
+__all__ = ['COPY_FALLBACK_ERRNOS', 'clone_file', 'copy_file', 'copy_range',
+           'link_file', 'write_all']
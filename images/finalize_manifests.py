@@ -20,6 +20,14 @@ final archive manifests used to make each package, and the build ID map.
 The "auxiliary" manifests just supply a pool of files that might be used to
 satisfy dependencies; their files are not included in the output a priori.
 
+With `--batch JOB_FILE...` as the only arguments, the tool runs many jobs
+in one process.  Each JOB_FILE holds the arguments for one ordinary run.
+The --elf-cache, --jobs and --trace options apply to the whole process,
+so every job must give the same values for them.
+The jobs share the work of parsing the auxiliary manifests and reading the
+ELF files they list, which is most of the work when there are many small
+packages using the same toolchain and Zircon manifests.
+
 The tool examines each file in its main input manifests.  If it's not an
 ELF file, it just goes into the appropriate output manifest.  If it's an
 ELF file, then the tool figures out what "variant" it is (if any), such as
@@ -33,16 +41,194 @@ asan versions of the toolchain/Zircon libraries.
 """
 
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import argparse
+import build_id_index
+import cPickle
+import elfinfo
+import errno
 import fnmatch
 import itertools
+import json
 import manifest
+import multiprocessing
 import os
+import stat_cache
 import sys
+import threading
+import tracing
 import variant
 
 
-binary_info = variant.binary_info
+# Bump this whenever the format of the --incremental-state file changes.
+INCREMENTAL_STATE_VERSION = 3
+
+
+# Returns the identity of a file for incremental_state: its
+# stat_cache.stat_key plus its link count, since find_variant looks at the
+# other hard links to it.  A missing file's fingerprint is None.
+def file_fingerprint(filename):
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return stat_cache.stat_key(st) + (st.st_nlink,)
+
+
+class incremental_state(object):
+    """The state that --incremental-state keeps from one run to the next.
+
+It holds the last run's finalize_result, the `key` of the inputs that
+produced it, and the fingerprint of every file that went into it: each
+file read or examined, and each place find_debug_file looked and found
+nothing.  If the key matches and no fingerprint has changed, the whole
+result is reused without reading anything.  Otherwise the closure is
+resolved again, but each file's ELF details and variant are taken from the
+state when its fingerprint matches, so only files that changed are read."""
+
+    def __init__(self, filename, key, load=True):
+        self.filename = filename
+        self.key = key
+        self.reused = False
+        self._old = (load and self._read()) or {
+            'key': None,
+            'files': {},
+            'result': None,
+            'infos': {},
+            'variants': {},
+        }
+        self._infos = {}
+        self._variants = {}
+        self._read_files = set()
+        self._missing = set()
+
+    def _read(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = cPickle.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            # A corrupt or truncated state is just no state.
+            return None
+        if (not isinstance(data, tuple) or len(data) != 2 or
+            data[0] != INCREMENTAL_STATE_VERSION):
+            return None
+        return data[1]
+
+    def reuse(self):
+        """Return the last run's finalize_result if it's still right."""
+        old = self._old
+        if old['key'] != self.key or old['result'] is None:
+            return None
+        for filename, fingerprint in old['files'].iteritems():
+            if file_fingerprint(filename) != fingerprint:
+                return None
+        self.reused = True
+        result = finalize_result(*old['result'])
+        return result._replace(debug_files=[debug_file(*info) for info
+                                            in result.debug_files])
+
+    def binary_info(self, filename):
+        self._read_files.add(filename)
+        fingerprint = file_fingerprint(filename)
+        old = self._old['infos'].get(filename)
+        if old is not None and old[0] == fingerprint is not None:
+            # The record's notes were already selected for variant.binary_info.
+            info = elfinfo.elf_info_from_record(filename, old[1], True)
+        else:
+            info = variant.binary_info(filename)
+        self._infos[filename] = (fingerprint, elfinfo.elf_record(info))
+        return info
+
+    def find_variant(self, info):
+        fingerprint = file_fingerprint(info.filename)
+        old = self._old['variants'].get(info.filename)
+        if old is not None and old[0] == fingerprint:
+            binary_variant, variant_file = variant.variant(*old[1]), old[2]
+        else:
+            binary_variant, variant_file = variant.find_variant(info)
+        self._variants[info.filename] = (fingerprint, tuple(binary_variant),
+                                         variant_file)
+        return binary_variant, variant_file
+
+    def note_missing(self, filename):
+        self._missing.add(filename)
+
+    def save(self, result):
+        """Record `result` (unless it was reused) in the state file."""
+        if self.reused:
+            return
+        files = self._read_files | self._missing | set(result.examined)
+        state = {
+            'key': self.key,
+            'files': dict((filename, file_fingerprint(filename))
+                          for filename in files),
+            # Only plain tuples go in, so the state doesn't depend on the
+            # name this module was loaded under.
+            'result': tuple(result._replace(
+                debug_files=[tuple(info) for info in result.debug_files],
+                force_update=False)),
+            'infos': self._infos,
+            'variants': self._variants,
+        }
+        stat_cache.replace_file(
+            self.filename,
+            cPickle.dumps((INCREMENTAL_STATE_VERSION, state),
+                          cPickle.HIGHEST_PROTOCOL))
+
+
+# When --incremental-state is used, this is the incremental_state.
+incremental = None
+
+
+# This maps file name to the result of variant.binary_info for each file
+# read by prefetch_binary_info.
+prefetched_binary_info = {}
+
+def read_binary_info(filename):
+    with tracing.span('binary_info', file=filename):
+        if incremental is not None:
+            return incremental.binary_info(filename)
+        return variant.binary_info(filename)
+
+def binary_info(filename):
+    if filename in prefetched_binary_info:
+        return prefetched_binary_info[filename]
+    return read_binary_info(filename)
+
+def find_variant(info):
+    if incremental is not None:
+        return incremental.find_variant(info)
+    return variant.find_variant(info)
+
+
+# Read the ELF details of all the given files on `jobs` threads, so that
+# the dependency walk later just does dictionary lookups.  The reading is
+# I/O-bound, so threads work as well as processes and they can share the
+# elf_info objects.  A file that can't be read is just left out here; it
+# gets read again (and reports the error) when it's actually used.
+def prefetch_binary_info(filenames, jobs):
+    def read(filename):
+        try:
+            return filename, read_binary_info(filename)
+        except (IOError, OSError):
+            return None
+    filenames = sorted(set(filenames) - set(prefetched_binary_info))
+    if jobs > 1 and len(filenames) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(read, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(read, filenames)
+    prefetched_binary_info.update(result for result in results if result)
 
 # An entry for a binary is (manifest.manifest_entry, elfinfo.elf_info).
 binary_entry = namedtuple('binary_entry', ['entry', 'info'])
@@ -61,13 +247,39 @@ output_manifest = namedtuple('output_manifest', ['file', 'manifest'])
 # Each --binary argument yields a input_binary tuple.
 input_binary = namedtuple('input_binary', ['target_pattern', 'output_group'])
 
+# A debug file for the build ID list.  (An elf_info works as one too.)
+debug_file = namedtuple('debug_file', ['build_id', 'filename'])
+
+# What compute_outputs decides, for write_outputs to write.
+finalize_result = namedtuple('finalize_result', [
+    'manifests',        # list of (file name, contents) for each --output
+    'debug_files',      # list of debug_file tuples, sorted
+    'examined',         # sorted list of files for the depfile
+    'warnings',         # list of strings to print
+    'force_update',     # bool: rewrite the manifests even if unchanged
+    'size_report',      # --size-report JSON object, or None
+    'load_report',      # --load-report JSON object, or None
+])
+
+
+# This maps a tuple of auxiliary manifest entries to the result of
+# collect_auxiliaries, since --batch jobs have the same auxiliaries.
+collected_auxiliaries = {}
 
 # Collect all the binaries from auxiliary manifests into
 # a dictionary mapping entry.target to binary_entry.
 def collect_auxiliaries(manifest, examined):
+    examined.update(entry.source for entry in manifest)
+    key = tuple(manifest)
+    aux_binaries = collected_auxiliaries.get(key)
+    if aux_binaries is None:
+        aux_binaries = collected_auxiliaries[key] = read_auxiliaries(manifest)
+    return aux_binaries
+
+
+def read_auxiliaries(manifest):
     aux_binaries = {}
     for entry in manifest:
-        examined.add(entry.source)
         info = binary_info(entry.source)
         if info:
             new_binary = binary_entry(entry, info)
@@ -82,7 +294,10 @@ def collect_auxiliaries(manifest, examined):
 # Return an iterable of binary_entry for all the binaries in `manifest` and
 # `input_binaries` and their dependencies from `aux_binaries`, and an
 # iterable of manifest_entry for all the other files in `manifest`.
-def collect_binaries(manifest, input_binaries, aux_binaries, examined):
+# The `dependencies` dictionary is filled in to map each binary's target
+# name to the set of target names it loads via PT_INTERP and DT_NEEDED.
+def collect_binaries(manifest, input_binaries, aux_binaries, examined,
+                     dependencies):
     # As we go, we'll collect the actual binaries for the output
     # in this dictionary mapping entry.target to binary_entry.
     binaries = {}
@@ -134,7 +349,7 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
 
         # If we're not part of a recursion, discover the binary's context.
         if context is None:
-            binary_variant, variant_file = variant.find_variant(binary.info)
+            binary_variant, variant_file = find_variant(binary.info)
             if variant_file is not None:
               # This is a variant that was actually built in a different
               # place than its original name says.  Rewrite everything to
@@ -149,6 +364,7 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
 
         binaries[binary.entry.target] = binary
         assert binary.entry.group is not None, binary
+        loads = dependencies.setdefault(binary.entry.target, set())
 
         if binary.info.soname:
             # This binary has a SONAME, so record it in the map.
@@ -164,9 +380,12 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
 
         # The PT_INTERP is implicitly required from an auxiliary manifest.
         if binary.info.interp:
-            add_auxiliary('lib/' + binary.info.interp, True)
+            interp = 'lib/' + binary.info.interp
+            add_auxiliary(interp, True)
+            loads.add(interp)
 
-        # The variant might require other auxiliary binaries too.
+        # The variant might require other auxiliary binaries too.  These
+        # go into the output, but the binary doesn't load them itself.
         for variant_aux, variant_aux_group in context.variant.aux:
             add_auxiliary(variant_aux, True, variant_aux_group)
 
@@ -179,6 +398,7 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
             lib = context.soname_map.get(soname)
             if lib and lib.entry.group <= binary.entry.group:
                 # Already handled this one in the same or earlier group.
+                loads.add(lib.entry.target)
                 continue
 
             # The DT_SONAME is libc.so, but the file is ld.so.1 on disk.
@@ -192,6 +412,7 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
                       soname)
             if add_auxiliary(target, auxiliary):
                 # We found it in an existing manifest.
+                loads.add(target)
                 continue
 
             # An auxiliary's dependencies must all be auxiliaries too.
@@ -216,6 +437,7 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
                 (soname, lib, binary, context.root_dependent))
 
             # Recurse.
+            loads.add(target)
             add_binary(lib, context)
 
     for entry in manifest:
@@ -250,38 +472,110 @@ def collect_binaries(manifest, input_binaries, aux_binaries, examined):
     return binaries.itervalues(), nonbinaries
 
 
+class unstripped_index(object):
+    """An index of the files in exe.unstripped and lib.unstripped
+directories, for find_debug_file.  Each directory is listed the first time
+a lookup needs it, and only then; the listing is kept for the rest of the
+process.  Only that directory is listed, not its subdirectories.  The
+counters say how many candidate files were checked against the listings
+(probes, each of which used to be a stat call), and how many lookups found
+a file (hits) or didn't (misses)."""
+
+    def __init__(self):
+        self.probes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    # Returns the set of names in dir, which is empty if it doesn't exist.
+    def _list(self, dir):
+        try:
+            return set(os.listdir(dir))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return set()
+
+    def files(self, dir):
+        dir = os.path.normpath(dir)
+        with self._lock:
+            files = self._dirs.get(dir)
+            if files is None:
+                files = self._dirs[dir] = self._list(dir)
+            return files
+
+    def find(self, candidates):
+        """Return the index of the first of the candidate (directory, file
+name) pairs whose file exists in that directory, or None."""
+        for i, (dir, file) in enumerate(candidates):
+            # The file name can have directories of its own, so look in
+            # the directory that actually contains it.
+            dir, file = os.path.split(os.path.join(dir, file))
+            with self._lock:
+                self.probes += 1
+            if file in self.files(dir):
+                with self._lock:
+                    self.hits += 1
+                return i
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def stats(self):
+        return ('debug file index: %d probes, %d hits, %d misses' %
+                (self.probes, self.hits, self.misses))
+
+
+# All the find_debug_file calls in the process share this index.
+unstripped_files = unstripped_index()
+
+
 # Take an iterable of binary_entry, and return list of binary_entry (all
 # stripped files), a list of binary_info (all debug files), and a boolean
 # saying whether any new stripped output files were written in the process.
-def strip_binary_manifest(manifest, stripped_dir, examined):
-    new_output = False
+# Warnings for binaries without debug files are appended to `warnings`.
+# The binaries are handled on `jobs` threads, but the results are in order.
+def strip_binary_manifest(manifest, stripped_dir, examined, warnings, jobs=1):
+    def note_missing(filename):
+        if incremental is not None:
+            incremental.note_missing(filename)
+
+    # In the GN build, the file to be installed is called foo and the
+    # unstripped file has the same name in the exe.unstripped or
+    # lib.unstripped subdirectory.  Yields each place it might be, in order,
+    # as the unstripped directory and the file name within it.
+    def gen_debug_file_candidates(filename):
+        dir, file = os.path.split(filename)
+        if file.endswith('.so') or '.so.' in file:
+            subdir = 'lib.unstripped'
+        else:
+            subdir = 'exe.unstripped'
+        yield os.path.join(dir, subdir), file
+        while True:
+            # For dir/foo/bar, if dir/foo/exe.unstripped/bar
+            # didn't exist, try dir/exe.unstripped/foo/bar.
+            parent, dir = os.path.split(dir)
+            if not parent or not dir:
+                return
+            dir, file = parent, os.path.join(dir, file)
+            yield os.path.join(dir, subdir), file
 
     def find_debug_file(filename):
         # In the Zircon makefile build, the file to be installed is called
-        # foo.strip and the unstripped file is called foo.  In the GN build,
-        # the file to be installed is called foo and the unstripped file has
-        # the same name in the exe.unstripped or lib.unstripped subdirectory.
+        # foo.strip and the unstripped file is called foo.
         if filename.endswith('.strip'):
             debugfile = filename[:-6]
         else:
-            dir, file = os.path.split(filename)
-            if file.endswith('.so') or '.so.' in file:
-                subdir = 'lib.unstripped'
-            else:
-                subdir = 'exe.unstripped'
-            debugfile = os.path.join(dir, subdir, file)
-            while not os.path.exists(debugfile):
-                # For dir/foo/bar, if dir/foo/exe.unstripped/bar
-                # didn't exist, try dir/exe.unstripped/foo/bar.
-                parent, dir = os.path.split(dir)
-                if not parent or not dir:
-                    return None
-                dir, file = parent, os.path.join(dir, file)
-                debugfile = os.path.join(dir, subdir, file)
-            if not os.path.exists(debugfile):
-                debugfile = os.path.join(subdir, filename)
-                if not os.path.exists(debugfile):
-                    return None
+            candidates = list(gen_debug_file_candidates(filename))
+            found = unstripped_files.find(candidates)
+            if found is None:
+                found = len(candidates)
+            for dir, file in candidates[:found]:
+                note_missing(os.path.join(dir, file))
+            if found == len(candidates):
+                return None
+            debugfile = os.path.join(*candidates[found])
         debug = binary_info(debugfile)
         assert debug, ("Debug file '%s' for '%s' is invalid" %
                        (debugfile, filename))
@@ -290,33 +584,55 @@ def strip_binary_manifest(manifest, stripped_dir, examined):
 
     # The toolchain-supplied shared libraries, and Go binaries, are
     # delivered unstripped.  For these, strip the binary right here and
-    # update the manifest entry to point to the stripped file.
+    # update the manifest entry to point to the stripped file.  The last
+    # value returned says whether the stripped file was written anew.
     def make_debug_file(entry, info):
         debug = info
         stripped = os.path.join(stripped_dir, entry.target)
         dir = os.path.dirname(stripped)
         if not os.path.isdir(dir):
-            os.makedirs(dir)
-        if info.strip(stripped):
-            new_output = True
+            try:
+                os.makedirs(dir)
+            except OSError as e:
+                # Another --batch job might have just made it.
+                if e.errno != errno.EEXIST:
+                    raise
+        changed = info.strip(stripped)
+        if changed:
+            tracing.add_counter('files stripped')
         info = binary_info(stripped)
         assert info, ("Stripped file '%s' for '%s' is invalid" %
                       (stripped, debug.filename))
         examined.add(debug.filename)
         examined.add(stripped)
-        return entry._replace(source=stripped), info, debug
+        return entry._replace(source=stripped), info, debug, changed
 
-    stripped_manifest = []
-    debug_list = []
-    for entry, info in manifest:
+    def process_binary(binary):
+        entry, info = binary
         assert entry.source == info.filename
         if info.stripped:
-            debug = find_debug_file(info.filename)
-        else:
-            entry, info, debug = make_debug_file(entry, info)
+            return entry, info, find_debug_file(info.filename), False
+        return make_debug_file(entry, info)
+
+    manifest = list(manifest)
+    if jobs > 1 and len(manifest) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(process_binary, manifest)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(process_binary, manifest)
+
+    stripped_manifest = []
+    debug_list = []
+    new_output = False
+    for entry, info, debug, changed in results:
+        new_output = new_output or changed
         stripped_manifest.append(binary_entry(entry, info))
         if debug is None:
-            print 'WARNING: no debug file found for %s' % info.filename
+            warnings.append('no debug file found for %s' % info.filename)
             continue
         assert debug.build_id, "'%s' has no build ID" % debug.filename
         assert not debug.stripped, "'%s' is stripped" % debug.filename
@@ -327,24 +643,263 @@ def strip_binary_manifest(manifest, stripped_dir, examined):
     return stripped_manifest, debug_list, new_output
 
 
-def emit_manifests(args, selected, unselected, input_binaries):
-    def update_file(file, contents, force=False):
-        if (not force and
-            os.path.exists(file) and
-            os.path.getsize(file) == len(contents)):
-            with open(file, 'r') as f:
-                if f.read() == contents:
-                    return
-        with open(file, 'w') as f:
-            f.write(contents)
+# Make `build_id_dir`/xx/rest.debug a link to each debug file whose build
+# ID is xxrest, which is where debuggers and symbolizers look for them.
+# Links are hard links when possible, so they keep working however the
+# build directory is moved around; otherwise they are absolute symlinks.
+# Each link is replaced atomically, and only if it's not already right.
+# A link is stale once the build has replaced the file it pointed to:
+# then a hard link is the last link to its file, or a symlink dangles.
+# Stale links are pruned from each xx subdirectory touched here.
+def update_build_id_dir(build_id_dir, debug_files):
+    subdirs = set()
+    for info in debug_files:
+        subdir = os.path.join(build_id_dir, info.build_id[:2])
+        link = os.path.join(subdir, info.build_id[2:] + '.debug')
+        subdirs.add(subdir)
+        try:
+            if os.path.samefile(link, info.filename):
+                continue
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            if not os.path.isdir(subdir):
+                try:
+                    os.makedirs(subdir)
+                except OSError as e:
+                    # Another process might have just made it.
+                    if e.errno != errno.EEXIST:
+                        raise
+        tmp = stat_cache.temp_filename(link)
+        try:
+            os.link(info.filename, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            os.symlink(os.path.abspath(info.filename), tmp)
+        os.rename(tmp, link)
+
+    for subdir in subdirs:
+        for name in os.listdir(subdir):
+            if not name.endswith('.debug'):
+                continue
+            link = os.path.join(subdir, name)
+            try:
+                if os.path.islink(link):
+                    stale = not os.path.exists(link)
+                else:
+                    stale = os.stat(link).st_nlink == 1
+                if stale:
+                    os.remove(link)
+            except OSError as e:
+                # Another process might have just pruned it.
+                if e.errno != errno.ENOENT:
+                    raise
+
 
+# Write one compressed debug file for compress_debug_files.  This runs in a
+# worker process.  The file name is the build ID, which identifies the
+# contents, so an existing file is already right.
+def compress_debug_file(job):
+    filename, output, compression = job
+    if os.path.exists(output):
+        return False
+    subdir = os.path.dirname(output)
+    if not os.path.isdir(subdir):
+        try:
+            os.makedirs(subdir)
+        except OSError as e:
+            # Another process might have just made it.
+            if e.errno != errno.EEXIST:
+                raise
+    elfinfo.get_elf_info(filename).compress_debug_sections(output,
+                                                           compression)
+    return True
+
+
+# Write `compressed_dir`/xx/rest.debug, a copy of each debug file whose
+# build ID is xxrest with its .debug_* sections compressed.  Compression is
+# CPU-bound, so this uses `jobs` processes.  Returns the elf_info list for
+# the compressed files, to use in place of `debug_files`.
+def compress_debug_files(compressed_dir, debug_files, compression, jobs):
+    # Fail early rather than in each worker.
+    elfinfo.get_debug_compressor(compression)
+    compress_jobs = [(info.filename,
+                      os.path.join(compressed_dir, info.build_id[:2],
+                                   info.build_id[2:] + '.debug'),
+                      compression)
+                     for info in debug_files]
+    if jobs > 1 and len(compress_jobs) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(compress_debug_file, compress_jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(compress_debug_file, compress_jobs)
+    compressed_files = []
+    for info, (filename, output, compression) in zip(debug_files,
+                                                      compress_jobs):
+        compressed = binary_info(output)
+        assert compressed.build_id == info.build_id, (
+            "%s: build ID %s does not match %s" %
+            (output, compressed.build_id, filename))
+        compressed_files.append(compressed)
+    return compressed_files
+
+
+# Return the set of target names that `target` loads, directly or
+# indirectly, given the `dependencies` from collect_binaries.
+def load_closure(target, dependencies):
+    libs = set()
+    pending = list(dependencies[target])
+    while pending:
+        lib = pending.pop()
+        if lib != target and lib not in libs:
+            libs.add(lib)
+            pending.extend(dependencies[lib])
+    return libs
+
+
+# Return the length of the longest chain of loads starting at `target`.
+# `depths` memoizes the results for each target.
+def load_depth(target, dependencies, depths):
+    depth = depths.get(target)
+    if depth is None:
+        # A dependency cycle ends the chain.
+        depths[target] = 0
+        depth = depths[target] = max([1 + load_depth(lib, dependencies,
+                                                     depths)
+                                      for lib in dependencies[target]] or
+                                     [0])
+    return depth
+
+
+# Each --load-FIELD-limit option applies to this field of a load_report
+# entry, which is described this way in its warning.
+LOAD_LIMITS = {
+    'objects': 'loads %d files',
+    'bytes': 'maps %d bytes of segments',
+    'depth': 'has a dependency chain %d deep',
+}
+
+# Return the --load-report JSON object estimating what the dynamic linker
+# does to start each executable or loadable module (each binary without a
+# DT_SONAME) among `binaries`: how many ELF files it loads including
+# itself, how many bytes of PT_LOAD segments they map, and the longest
+# chain of dependencies.  Each entry over one of the `limits` (a dictionary
+# mapping a LOAD_LIMITS field to the limit or None) adds a warning.
+def load_report(binaries, dependencies, limits, warnings):
+    infos = dict((binary.entry.target, binary.info) for binary in binaries)
+    depths = {}
+    report = {}
+    for target, info in sorted(infos.iteritems()):
+        if info.soname:
+            continue
+        libs = load_closure(target, dependencies)
+        cost = {
+            'objects': 1 + len(libs),
+            'bytes': info.load_size() + sum(infos[lib].load_size()
+                                            for lib in libs),
+            'depth': load_depth(target, dependencies, depths),
+            'libraries': sorted(libs),
+        }
+        report[target] = cost
+        for field, description in sorted(LOAD_LIMITS.iteritems()):
+            limit = limits[field]
+            if limit is not None and cost[field] > limit:
+                warnings.append('%s %s, over --load-%s-limit=%d' %
+                                (target, description % cost[field],
+                                 field, limit))
+    return report
+
+
+# Return the --size-report JSON object for the collated `outputs` (a list
+# of output_manifest), given the `dependencies` from collect_binaries.  A
+# root binary is one that no other binary loads.  Each library's bytes are
+# shared evenly among the roots that load it directly or indirectly, so
+# the roots' attributed_bytes add up to all the binary bytes.
+def size_report(outputs, dependencies):
+    sizes = {}
+    groups = {}
+    for group, output in enumerate(outputs):
+        for entry in output.manifest:
+            sizes[entry.target] = os.path.getsize(entry.source)
+            groups[entry.target] = group
+
+    loaded = set().union(*dependencies.itervalues())
+    roots = sorted(target for target in dependencies if target not in loaded)
+    libraries = {}
+    dependents = {}
+    for root in roots:
+        libraries[root] = sorted(load_closure(root, dependencies))
+        for lib in libraries[root]:
+            dependents.setdefault(lib, []).append(root)
+
+    attributed = dict((root, sizes[root]) for root in roots)
+    for lib, users in dependents.iteritems():
+        # Give any remainder to the first users so the shares add up.
+        share, extra = divmod(sizes[lib], len(users))
+        for i, root in enumerate(users):
+            attributed[root] += share + (1 if i < extra else 0)
+
+    report = []
+    for group, output in enumerate(outputs):
+        files = dict((entry.target, sizes[entry.target])
+                     for entry in output.manifest)
+        group_libraries = [lib for lib in sorted(dependents)
+                           if groups[lib] == group]
+        report.append({
+            'manifest': output.file,
+            'bytes': sum(files.itervalues()),
+            'files': files,
+            'binaries': dict(
+                (root, {
+                    'bytes': sizes[root],
+                    'libraries': libraries[root],
+                    'library_bytes': sum(sizes[lib]
+                                         for lib in libraries[root]),
+                    'attributed_bytes': attributed[root],
+                })
+                for root in roots if groups[root] == group),
+            'libraries': dict(
+                (lib, {
+                    'bytes': sizes[lib],
+                    'dependents': dependents[lib],
+                })
+                for lib in group_libraries),
+            'single_dependent_libraries': dict(
+                (lib, dependents[lib][0])
+                for lib in group_libraries if len(dependents[lib]) == 1),
+        })
+    return {'outputs': report}
+
+
+# Resolve everything and return a finalize_result.  This writes only the
+# stripped files.
+def compute_outputs(args, selected, unselected, input_binaries):
     # The name of every file we examine to make decisions goes into this set.
     examined = set(args.manifest)
+    warnings = []
+
+    # Read all the ELF files in parallel up front.  Data resources in the
+    # selected manifest are never inspected (see collect_binaries).
+    with tracing.span('prefetch_binary_info'):
+        prefetch_binary_info(
+            itertools.chain((entry.source for entry in unselected),
+                            (entry.source for entry in selected
+                             if not entry.target.startswith('data/'))),
+            args.jobs)
 
     # Collect all the inputs and reify.
-    aux_binaries = collect_auxiliaries(unselected, examined)
-    binaries, nonbinaries = collect_binaries(selected, input_binaries,
-                                             aux_binaries, examined)
+    with tracing.span('collect_auxiliaries'):
+        aux_binaries = collect_auxiliaries(unselected, examined)
+    dependencies = {}
+    with tracing.span('collect_binaries'):
+        binaries, nonbinaries = collect_binaries(selected, input_binaries,
+                                                 aux_binaries, examined,
+                                                 dependencies)
 
     # Prepare to collate groups.
     outputs = [output_manifest(file, []) for file in args.output]
@@ -355,44 +910,164 @@ def emit_manifests(args, selected, unselected, input_binaries):
     # having touched any of its outputs, and GN/Ninja doesn't know that the
     # stripped files are implicit outputs (there's no such thing as a depfile
     # for outputs, only for inputs).
-    binaries, debug_files, force_update = strip_binary_manifest(
-        binaries, args.stripped_dir, examined)
+    with tracing.span('strip_binary_manifest'):
+        binaries, debug_files, force_update = strip_binary_manifest(
+            binaries, args.stripped_dir, examined, warnings, args.jobs)
+    tracing.add_counter('files examined', len(examined))
 
     # Collate groups.
     for entry in itertools.chain((binary.entry for binary in binaries),
                                  nonbinaries):
         outputs[entry.group].manifest.append(entry._replace(group=None))
 
-    all_binaries = {binary.info.build_id: binary.entry for binary in binaries}
     all_debug_files = {info.build_id: info for info in debug_files}
 
-    # Emit each primary manifest.
+    # Sort so that functionally identical output is textually identical.
     for output in outputs:
-        depfile_output = output.file
-        # Sort so that functionally identical output is textually
-        # identical.
         output.manifest.sort(key=lambda entry: entry.target)
-        update_file(output.file,
-                    manifest.format_manifest_file(output.manifest),
-                    force_update)
-
-    # Emit the build ID list.
-    # Sort so that functionally identical output is textually identical.
     debug_files = sorted(all_debug_files.itervalues(),
                          key=lambda info: info.build_id)
-    update_file(args.build_id_file, ''.join(
-        info.build_id + ' ' + os.path.abspath(info.filename) + '\n'
-        for info in debug_files))
+
+    report = None
+    if args.size_report:
+        # The report depends on the size of every file, not just binaries.
+        examined.update(entry.source for entry in nonbinaries)
+        report = size_report(outputs, dependencies)
+
+    limits = dict((field, getattr(args, 'load_%s_limit' % field))
+                  for field in LOAD_LIMITS)
+    load_costs = None
+    if args.load_report or any(limit is not None
+                               for limit in limits.itervalues()):
+        with tracing.span('load_report'):
+            load_costs = load_report(binaries, dependencies, limits, warnings)
+
+    return finalize_result(
+        [(output.file, manifest.format_manifest_file(output.manifest))
+         for output in outputs],
+        [debug_file(info.build_id, info.filename) for info in debug_files],
+        sorted(examined),
+        warnings,
+        force_update,
+        report,
+        load_costs)
+
+
+def update_file(file, contents, force=False):
+    with tracing.span('update_file', file=file):
+        if (not force and
+            os.path.exists(file) and
+            os.path.getsize(file) == len(contents)):
+            with open(file, 'r') as f:
+                if f.read() == contents:
+                    return
+        with open(file, 'w') as f:
+            f.write(contents)
+
+
+# Write everything but what write_debug_outputs writes, and then that too
+# if `debug_outputs` is set.
+def write_outputs(args, result, debug_outputs=True):
+    # --batch jobs can run on several threads, so each line goes out in one
+    # write rather than print's separate writes of the text and newline.
+    sys.stdout.write(''.join('WARNING: %s\n' % warning
+                             for warning in result.warnings))
+
+    # Emit each primary manifest.
+    for file, contents in result.manifests:
+        depfile_output = file
+        update_file(file, contents, result.force_update)
+
+    if debug_outputs:
+        write_debug_outputs(args, result.debug_files, args.jobs)
+
+    for file, report in [(args.size_report, result.size_report),
+                         (args.load_report, result.load_report)]:
+        if file:
+            update_file(file,
+                        json.dumps(report, indent=2, sort_keys=True,
+                                   separators=(',', ': ')) + '\n')
 
     # Emit the depfile.
     if args.depfile:
         with open(args.depfile, 'w') as f:
             f.write(depfile_output + ':')
-            for file in sorted(examined):
+            for file in result.examined:
                 f.write(' ' + file)
             f.write('\n')
 
 
+# Write the build ID list and whatever else describes the debug files,
+# compressing them first if need be on `jobs` processes.  This must not run
+# while other threads might hold locks, since the processes are forked.
+def write_debug_outputs(args, debug_files, jobs):
+    if args.compressed_debug_dir:
+        with tracing.span('compress_debug_files'):
+            debug_files = compress_debug_files(args.compressed_debug_dir,
+                                               debug_files,
+                                               args.debug_compression,
+                                               jobs)
+    update_file(args.build_id_file, ''.join(
+        info.build_id + ' ' + os.path.abspath(info.filename) + '\n'
+        for info in debug_files))
+    if args.build_id_index:
+        build_id_index.write_index(
+            args.build_id_index,
+            ((info.build_id, os.path.abspath(info.filename))
+             for info in debug_files))
+    if args.build_id_dir:
+        with tracing.span('update_build_id_dir'):
+            update_build_id_dir(args.build_id_dir, debug_files)
+
+
+# Compute and write the outputs, and return the finalize_result.  Without
+# `debug_outputs`, the caller must call write_debug_outputs afterwards.
+def emit_manifests(args, selected, unselected, input_binaries,
+                   debug_outputs=True):
+    global incremental
+    if not args.incremental_state:
+        result = compute_outputs(args, selected, unselected, input_binaries)
+        write_outputs(args, result, debug_outputs)
+        return result
+
+    # Anything that changes what compute_outputs does must be in the key.
+    key = (os.getcwd(),
+           args.stripped_dir,
+           args.output,
+           [tuple(entry) for entry in selected],
+           [tuple(entry) for entry in unselected],
+           [tuple(binary) for binary in input_binaries],
+           bool(args.size_report),
+           bool(args.load_report),
+           [getattr(args, 'load_%s_limit' % field)
+            for field in sorted(LOAD_LIMITS)])
+    incremental = incremental_state(args.incremental_state, key)
+    result = incremental.reuse()
+    if result is None:
+        result = compute_outputs(args, selected, unselected, input_binaries)
+
+    mismatch = None
+    if args.verify_incremental:
+        # Do it all again from scratch and compare.
+        incremental_result = result
+        prefetched_binary_info.clear()
+        collected_auxiliaries.clear()
+        incremental = incremental_state(args.incremental_state, key, False)
+        result = compute_outputs(args, selected, unselected, input_binaries)
+        mismatch = [field for field in ['manifests', 'debug_files', 'examined',
+                                        'warnings', 'size_report',
+                                        'load_report']
+                    if getattr(result, field) !=
+                    getattr(incremental_result, field)]
+
+    incremental.save(result)
+    write_outputs(args, result, debug_outputs)
+    if mismatch:
+        raise Exception('--verify-incremental: %s differ from a full run' %
+                        ', '.join(mismatch))
+    return result
+
+
 class input_binary_action(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         binaries = getattr(namespace, self.dest, None)
@@ -404,8 +1079,8 @@ class input_binary_action(argparse.Action):
         binaries.append(input_binary(values, output_group))
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(description='''
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='''
 Massage manifest files from the build to produce images.
 ''',
         epilog='''
@@ -419,21 +1094,183 @@ is used for shared libraries and the like.
     parser.add_argument('--build-id-file', required=True,
                         metavar='FILE',
                         help='Output build ID list')
+    parser.add_argument('--build-id-index',
+                        metavar='FILE',
+                        help='Output build ID list in binary index form')
+    parser.add_argument('--build-id-dir',
+                        metavar='DIR',
+                        help='Update DIR/xx/rest.debug links to debug files')
+    parser.add_argument('--compressed-debug-dir',
+                        metavar='DIR',
+                        help=('Write DIR/xx/rest.debug copies of debug' +
+                              ' files with compressed .debug_* sections,' +
+                              ' and list those as the debug files'))
+    parser.add_argument('--debug-compression',
+                        choices=['zlib', 'zstd'], default='zlib',
+                        help='Compression for --compressed-debug-dir')
     parser.add_argument('--depfile',
                         metavar='DEPFILE',
                         help='Ninja depfile to write')
+    parser.add_argument('--size-report',
+                        metavar='FILE',
+                        help=('Write JSON of the file sizes in each output' +
+                              ' and the shared libraries each binary loads'))
+    parser.add_argument('--load-report',
+                        metavar='FILE',
+                        help=('Write JSON estimating the dynamic loading' +
+                              ' work to start each executable'))
+    parser.add_argument('--load-objects-limit', type=int,
+                        metavar='N',
+                        help='Warn about executables loading over N files')
+    parser.add_argument('--load-bytes-limit', type=int,
+                        metavar='N',
+                        help=('Warn about executables mapping over N bytes' +
+                              ' of segments'))
+    parser.add_argument('--load-depth-limit', type=int,
+                        metavar='N',
+                        help=('Warn about executables with dependency chains' +
+                              ' over N deep'))
     parser.add_argument('--binary', action=input_binary_action, default=[],
                         metavar='PATH',
                         help='Take matching binaries from auxiliary manifests')
     parser.add_argument('--stripped-dir', required=True,
                         metavar='STRIPPED_DIR',
                         help='Directory to hold stripped copies when needed')
-    return manifest.common_parse_args(parser)
+    parser.add_argument('--elf-cache',
+                        metavar='FILE',
+                        help='Persistent cache of ELF file details')
+    parser.add_argument('--incremental-state',
+                        metavar='FILE',
+                        help='Reuse and update the results saved in FILE')
+    parser.add_argument('--verify-incremental', action='store_true',
+                        help=('Check that --incremental-state gives the' +
+                              ' same results as a full run'))
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=multiprocessing.cpu_count(),
+                        metavar='N',
+                        help='Read up to N files in parallel')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print counts of file system work done')
+    args = manifest.common_parse_args(parser, argv)
+    if (args.compressed_debug_dir and args.build_id_dir and
+        os.path.abspath(args.compressed_debug_dir) ==
+        os.path.abspath(args.build_id_dir)):
+        # update_build_id_dir would prune the compressed files as stale.
+        parser.error('--compressed-debug-dir must differ from --build-id-dir')
+    if args.verify_incremental and not args.incremental_state:
+        parser.error('--verify-incremental requires --incremental-state')
+    return args
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='finalize_manifests.py --batch',
+        description='Run many finalize_manifests.py jobs in one process.')
+    parser.add_argument('--elf-cache',
+                        metavar='FILE',
+                        help='Persistent cache of ELF file details')
+    parser.add_argument('--jobs', '-j', type=int,
+                        metavar='N',
+                        help='Run up to N jobs or read up to N files at once' +
+                        ' (default: the jobs\' --jobs)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print counts of file system work done')
+    parser.add_argument('--trace',
+                        metavar='FILE',
+                        help='Write a Chrome trace of all the jobs to FILE')
+    parser.add_argument('job_files', nargs='+',
+                        metavar='JOB_FILE',
+                        help='Response file of arguments for one job')
+    start = tracing.now()
+    batch_args = parser.parse_args(argv)
+
+    # Parse all the jobs first, so any usage error comes before any work.
+    jobs = []
+    for job_file in batch_args.job_files:
+        args = parse_args(['@' + job_file],
+                          'finalize_manifests.py @' + job_file)
+        if args.incremental_state:
+            # The incremental_state is global to the process.
+            parser.error(('%s: --incremental-state is not supported in' +
+                          ' --batch jobs') % job_file)
+        jobs.append(args)
+
+    # These options apply to the whole process, so the jobs must agree on
+    # them.  A job's --elf-cache or --trace must also match --batch's, but
+    # --batch's own --jobs overrides the jobs'.
+    for option in ['elf_cache', 'jobs', 'trace']:
+        flag = '--' + option.replace('_', '-')
+        values = set(getattr(args, option) for args in jobs)
+        if len(values) > 1:
+            parser.error('jobs give different %s values: %s' %
+                         (flag, ', '.join(sorted(map(str, values)))))
+        [value] = values
+        batch_value = getattr(batch_args, option)
+        if batch_value is None:
+            setattr(batch_args, option, value)
+        elif option != 'jobs' and value not in (None, batch_value):
+            parser.error('%s=%s differs from the jobs\' %s=%s' %
+                         (flag, batch_value, flag, value))
+    if batch_args.elf_cache:
+        elfinfo.enable_cache(batch_args.elf_cache)
+    if batch_args.trace:
+        tracing.enable(batch_args.trace, 'finalize_manifests.py --batch')
+    tracing.add_span('parse_args', start)
+
+    # Read every job's ELF files up front, each file just once.
+    prefetch_binary_info(
+        itertools.chain.from_iterable(
+            itertools.chain((entry.source for entry in args.unselected),
+                            (entry.source for entry in args.selected
+                             if not entry.target.startswith('data/')))
+            for args in jobs),
+        batch_args.jobs)
+
+    def run_job(args):
+        with tracing.span('job', output=args.output[-1]):
+            return emit_manifests(args, args.selected, args.unselected,
+                                  args.binary, False)
+    if batch_args.jobs > 1 and len(jobs) > 1:
+        # The jobs run in parallel, so each one runs its own work serially
+        # rather than multiplying the threads.
+        for args in jobs:
+            args.jobs = 1
+        pool = ThreadPool(batch_args.jobs)
+        try:
+            results = pool.map(run_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_job, jobs)
+
+    # Debug file compression forks processes, so it waits until no other
+    # threads are running.
+    for args, result in zip(jobs, results):
+        with tracing.span('job debug files', output=args.output[-1]):
+            write_debug_outputs(args, result.debug_files, batch_args.jobs)
+    if batch_args.stats:
+        print_stats()
+
+
+def print_stats():
+    print unstripped_files.stats()
 
 
 def main():
+    if sys.argv[1:2] == ['--batch']:
+        return batch_main(sys.argv[2:])
+    start = tracing.now()
     args = parse_args()
+    if args.elf_cache:
+        elfinfo.enable_cache(args.elf_cache)
+    if args.trace:
+        tracing.enable(args.trace,
+                       'finalize_manifests.py %s' % args.output[-1])
+        tracing.add_span('parse_args', start)
     emit_manifests(args, args.selected, args.unselected, args.binary)
+    if args.stats:
+        print_stats()
 
 
 if __name__ == "__main__":
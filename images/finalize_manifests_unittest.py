@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import elfinfo
+import finalize_manifests
+import manifest
+import variant
+
+
+X64 = elfinfo.ELF_MACHINE_TO_CPU[elfinfo.EM_X86_64]
+DRIVER_NOTE = (variant.ZIRCON_DRIVER_IDENT, '')
+
+
+class CollectBinariesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        # Auxiliary files are outside the build directory, so find_variant
+        # doesn't look for hard links to them.
+        os.mkdir(os.path.join(self.dir, 'build'))
+        os.chdir(os.path.join(self.dir, 'build'))
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+        finalize_manifests.prefetched_binary_info.clear()
+
+    # Returns a manifest_entry for `target`, whose ELF details are
+    # prefetched as if read from the file.
+    def binary(self, target, notes=[], soname=None, needed=[]):
+        source = os.path.join(self.dir, 'aux', target)
+        info = elfinfo.elf_info(source, X64, notes, None, False, None,
+                                soname, needed)
+        finalize_manifests.prefetched_binary_info[source] = info
+        return manifest.manifest_entry(1, target, source, 'test.manifest')
+
+    def collect(self, entries, aux_entries):
+        aux_binaries = finalize_manifests.read_auxiliaries(aux_entries)
+        dependencies = {}
+        binaries, nonbinaries = finalize_manifests.collect_binaries(
+            entries, [], aux_binaries, set(), dependencies)
+        return sorted(binary.entry.target for binary in binaries), dependencies
+
+    def test_variant_aux_not_loaded(self):
+        targets, dependencies = self.collect(
+            [self.binary('driver/foo.so', notes=[DRIVER_NOTE],
+                         needed=['libdriver.so'])],
+            [self.binary('bin/devhost'),
+             self.binary('lib/libdriver.so', soname='libdriver.so')])
+        # The driver's devhost goes into the output...
+        self.assertEqual(targets,
+                         ['bin/devhost', 'driver/foo.so', 'lib/libdriver.so'])
+        # ...but it isn't something the driver loads.
+        self.assertEqual(dependencies['driver/foo.so'],
+                         set(['lib/libdriver.so']))
+        self.assertEqual(
+            finalize_manifests.load_closure('driver/foo.so', dependencies),
+            set(['lib/libdriver.so']))
+        self.assertEqual(
+            finalize_manifests.load_depth('driver/foo.so', dependencies, {}),
+            1)
+
+
+if __name__ == '__main__':
+    unittest.main()
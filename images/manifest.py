@@ -3,14 +3,21 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-from collections import namedtuple
+from collections import Counter, namedtuple
+from multiprocessing.pool import ThreadPool
 import argparse
 import os
 import errno
+import file_copy
+import manifest_index
 import fnmatch
+import merkle
+import multiprocessing
+import re
 import shlex
-import shutil
+import stat_cache
 import sys
+import tracing
 
 
 manifest_entry = namedtuple('manifest_entry', [
@@ -22,45 +29,123 @@ manifest_entry = namedtuple('manifest_entry', [
 
 
 def format_manifest_entry(entry):
-    return (('' if entry.group is None else '{' + entry.group + '}') +
-            entry.target + '=' + entry.source)
+    return format_manifest_line('=', entry.group, entry.target, entry.source)
+
+
+def format_manifest_line(sep, group, target, source):
+    return (('' if group is None else '{' + group + '}') +
+            target + sep + source)
 
 
 def format_manifest_file(manifest):
     return ''.join(format_manifest_entry(entry) + '\n' for entry in manifest)
 
 
+class path_translator(object):
+    """Translates paths relative to `from_cwd` into normalized paths relative
+to `to_cwd`, as os.path.relpath(os.path.normpath(os.path.join(from_cwd, path)),
+to_cwd) would.  The relative path between the two directories is computed
+once, and a path with no `.` or `..` components, empty components or leading
+slash just gets it prepended.  Others take the slow way."""
+
+    def __init__(self, from_cwd, to_cwd):
+        self.from_cwd = from_cwd
+        self.to_cwd = to_cwd
+        prefix = os.path.relpath(from_cwd or os.curdir, to_cwd)
+        if prefix == os.curdir:
+            self.prefix = ''
+        else:
+            self.prefix = prefix + '/'
+        # When from_cwd is an ancestor of to_cwd, a path that leads back
+        # down toward to_cwd comes out shorter than prefix + path.  Paths
+        # whose first component is the first step down take the slow way.
+        self.descent = None
+        if prefix != os.curdir and all(part == os.pardir
+                                       for part in prefix.split('/')):
+            descent = os.path.relpath(to_cwd or os.curdir,
+                                      from_cwd or os.curdir)
+            self.descent = descent.split('/', 1)[0]
+
+    def __call__(self, path):
+        padded = '/' + path + '/'
+        if ('//' in padded or '/./' in padded or '/../' in padded or
+            (self.descent is not None and
+             path.split('/', 1)[0] == self.descent)):
+            return os.path.relpath(
+                os.path.normpath(os.path.join(self.from_cwd, path)),
+                self.to_cwd)
+        return self.prefix + path
+
+
+# This maps (from_cwd, to_cwd) to its path_translator, since the same
+# manifests are read relative to the same directories over and over.
+path_translators = {}
+
+def get_path_translator(from_cwd, to_cwd):
+    key = (from_cwd, to_cwd)
+    translator = path_translators.get(key)
+    if translator is None:
+        translator = path_translators[key] = path_translator(from_cwd, to_cwd)
+    return translator
+
+
 def read_manifest_lines(sep, lines, title, manifest_cwd, result_cwd):
     for line in lines:
         # Remove the trailing newline.
         assert line.endswith('\n'), "Unterminated manifest line: %r" % line
-        line = line[:-1]
+        entry = parse_manifest_line(sep, line[:-1], title,
+                                    manifest_cwd, result_cwd)
+        if entry is not None:
+            yield entry
+
 
-        # Grok {group}... syntax.
-        group = None
-        if line.startswith('{'):
-            end = line.find('}')
-            assert end > 0, "Unterminated { in manifest line: %r" % line
-            group = line[1:end]
-            line = line[end + 1:]
+def read_manifest_index(index, title, manifest_cwd, result_cwd):
+    for group, target_file, build_file in index:
+        entry = make_manifest_entry(group, target_file, build_file, title,
+                                    manifest_cwd, result_cwd)
+        if entry is not None:
+            yield entry
 
-        # Grok target=source syntax.
-        [target_file, build_file] = line.split(sep, 1)
 
-        if manifest_cwd != result_cwd:
-            # Expand the path based on the cwd presumed in the manifest.
-            build_file = os.path.normpath(os.path.join(manifest_cwd,
-                                                       build_file))
-            # Make it relative to the cwd we want to work from.
-            build_file = os.path.relpath(build_file, result_cwd)
+# Returns (group, target, source) for one line (without its newline).
+def split_manifest_line(sep, line):
+    # Grok {group}... syntax.
+    group = None
+    if line.startswith('{'):
+        end = line.find('}')
+        assert end > 0, "Unterminated { in manifest line: %r" % line
+        group = line[1:end]
+        line = line[end + 1:]
 
-        # TODO(mcgrathr): Dismal kludge to avoid pulling in asan runtime
-        # libraries from the zircon ulib bootfs.manifest because their source
-        # file names don't match the ones in the toolchain manifest.
-        if 'prebuilt/downloads/clang/lib/' in build_file:
-            continue
+    # Grok target=source syntax.
+    [target_file, build_file] = line.split(sep, 1)
+    return group, target_file, build_file
 
-        yield manifest_entry(group, target_file, build_file, title)
+
+# Returns the manifest_entry for one line (without its newline), or None
+# if it should be ignored.
+def parse_manifest_line(sep, line, title, manifest_cwd, result_cwd):
+    group, target_file, build_file = split_manifest_line(sep, line)
+    return make_manifest_entry(group, target_file, build_file, title,
+                               manifest_cwd, result_cwd)
+
+
+# Returns the manifest_entry for a split manifest line, or None if it should
+# be ignored.
+def make_manifest_entry(group, target_file, build_file, title,
+                        manifest_cwd, result_cwd):
+    if manifest_cwd != result_cwd:
+        # Expand the path based on the cwd presumed in the manifest, and
+        # make it relative to the cwd we want to work from.
+        build_file = get_path_translator(manifest_cwd, result_cwd)(build_file)
+
+    # TODO(mcgrathr): Dismal kludge to avoid pulling in asan runtime
+    # libraries from the zircon ulib bootfs.manifest because their source
+    # file names don't match the ones in the toolchain manifest.
+    if 'prebuilt/downloads/clang/lib/' in build_file:
+        return None
+
+    return manifest_entry(group, target_file, build_file, title)
 
 
 def partition_manifest(manifest, select, selected_group, unselected_group):
@@ -75,15 +160,20 @@ def partition_manifest(manifest, select, selected_group, unselected_group):
 
 
 def ingest_manifest_lines(sep, lines, title, in_cwd, groups, out_cwd, output_group):
+    return ingest_manifest_entries(
+        read_manifest_lines(sep, lines, title, in_cwd, out_cwd),
+        groups, output_group)
+
+
+def ingest_manifest_entries(manifest, groups, output_group):
     groups_seen = set()
     def select(group):
         groups_seen.add(group)
         if isinstance(groups, bool):
             return groups
         return group in groups
-    selected, unselected = partition_manifest(
-        read_manifest_lines(sep, lines, title, in_cwd, out_cwd),
-        select, output_group, None)
+    selected, unselected = partition_manifest(manifest, select,
+                                              output_group, None)
     return selected, unselected, groups_seen
 
 
@@ -94,16 +184,71 @@ def apply_source_rewrites(rewrites, entry):
     return entry
 
 
-def apply_rewrites(sep, rewrites, entry):
-    for pattern, line in rewrites:
-        if fnmatch.fnmatchcase(entry.target, pattern):
-            [new_entry] = read_manifest_lines(
-                sep,
-                [line.format(**entry._asdict()) + '\n'], entry.manifest,
-                os.path.dirname(entry.manifest),
-                os.path.dirname(entry.manifest))
-            entry = new_entry._replace(group=entry.group)
-    return entry
+class glob_set(object):
+    """Matches names against a list of fnmatch patterns all at once.
+Patterns with no wildcards are looked up in a set, and all the rest are
+combined into one regular expression."""
+
+    def __init__(self, patterns):
+        self.literals = set()
+        globs = []
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                globs.append(pattern)
+            else:
+                self.literals.add(pattern)
+        self._match = None
+        if globs:
+            self._match = re.compile('|'.join('(?:%s)' %
+                                              fnmatch.translate(pattern)
+                                              for pattern in globs)).match
+
+    def matches(self, name):
+        return (name in self.literals or
+                (self._match is not None and self._match(name) is not None))
+
+
+# This maps a tuple of patterns to its glob_set, since the same --include,
+# --exclude and --rewrite lists apply to many --manifest arguments.
+compiled_globs = {}
+
+def get_glob_set(patterns):
+    patterns = tuple(patterns)
+    globs = compiled_globs.get(patterns)
+    if globs is None:
+        globs = compiled_globs[patterns] = glob_set(patterns)
+    return globs
+
+
+class manifest_rewriter(object):
+    """Applies --rewrite arguments (each PATTERN=ENTRY) to manifest entries.
+Each rewrite that matches an entry's target replaces the entry, and later
+rewrites see the new entry.  An entry that no pattern matches costs just
+one combined regular expression match."""
+
+    def __init__(self, sep, rewrites):
+        self.sep = sep
+        self.rewrites = [rewrite.split('=', 1) for rewrite in rewrites]
+        self.any_matches = glob_set(pattern for pattern, line
+                                    in self.rewrites).matches
+        self.rewrites = [(pattern, glob_set([pattern]).matches, line)
+                         for pattern, line in self.rewrites]
+
+    def __call__(self, entry):
+        if not self.rewrites or not self.any_matches(entry.target):
+            return entry
+        for pattern, matches, line in self.rewrites:
+            if matches(entry.target):
+                manifest_dir = os.path.dirname(entry.manifest)
+                # _asdict makes an OrderedDict, which is much slower.
+                fields = dict(zip(entry._fields, entry))
+                new_entry = parse_manifest_line(
+                    self.sep, line.format(**fields), entry.manifest,
+                    manifest_dir, manifest_dir)
+                assert new_entry is not None, (
+                    "--rewrite=%s=%s ignores %r" % (pattern, line, entry))
+                entry = new_entry._replace(group=entry.group)
+        return entry
 
 
 def contents_entry(entry):
@@ -150,16 +295,16 @@ class input_action_base(argparse.Action):
         include_source = getattr(namespace, 'include_source', [])
         exclude = getattr(namespace, 'exclude', [])
         if include or exclude or include_source:
+            include = include and get_glob_set(include).matches
+            include_source = (include_source and
+                              get_glob_set(include_source).matches)
+            exclude = exclude and get_glob_set(exclude).matches
             def included(entry):
-                def matches(file, patterns):
-                    return any(fnmatch.fnmatch(file, pattern)
-                               for pattern in patterns)
-                if matches(entry.target, exclude):
+                if exclude and exclude(entry.target):
                     return False
-                if include and not matches(entry.target, include):
+                if include and not include(entry.target):
                     return False
-                return (not include_source or
-                        matches(entry.source, include_source))
+                return not include_source or include_source(entry.source)
             unselected += filter(lambda entry: not included(entry), selected)
             selected = filter(included, selected)
 
@@ -167,11 +312,12 @@ class input_action_base(argparse.Action):
             selected = map(contents_entry, selected);
             unselected = map(contents_entry, unselected);
 
-        sep = getattr(namespace, 'separator', '=')
-        rewrites = [entry.split('=', 1)
-                     for entry in getattr(namespace, 'rewrite', [])]
-        selected = [apply_rewrites(sep, rewrites, entry) for entry in selected]
-        unselected = [apply_rewrites(sep, rewrites, entry) for entry in unselected]
+        rewrites = getattr(namespace, 'rewrite', [])
+        if rewrites:
+            rewrite = manifest_rewriter(getattr(namespace, 'separator', '='),
+                                        rewrites)
+            selected = map(rewrite, selected)
+            unselected = map(rewrite, unselected)
 
         if not isinstance(groups, bool):
             unused_groups = groups - groups_seen - set([None])
@@ -186,18 +332,42 @@ class input_action_base(argparse.Action):
 
 
 class input_manifest_action(input_action_base):
+    # This maps the arguments of each ingest_manifest_lines call on a file
+    # to its results, since a process parsing many command lines (like
+    # finalize_manifests.py --batch) sees the same manifests many times.
+    ingested = {}
+
     def __init__(self, *args, **kwargs):
         super(input_manifest_action, self).__init__(*args, **kwargs)
 
-    def get_manifest_lines(self, namespace, filename, *args):
+    def get_manifest_lines(self, namespace, filename, cwd, groups,
+                           out_cwd, output_group):
         all_inputs = getattr(namespace, 'manifest', None)
         if all_inputs is None:
             all_inputs = []
             setattr(namespace, 'manifest', all_inputs)
         all_inputs.append(filename)
-        with open(filename, 'r') as file:
-            return ingest_manifest_lines(getattr(namespace, 'separator', '='),
-                                         file, file.name, *args)
+        sep = getattr(namespace, 'separator', '=')
+        key = (filename, sep, cwd,
+               groups if isinstance(groups, bool) else frozenset(groups),
+               out_cwd, output_group)
+        result = self.ingested.get(key)
+        if result is None:
+            with open(filename, 'r') as file:
+                if manifest_index.is_manifest_index(file):
+                    with manifest_index.manifest_index(filename) as index:
+                        result = ingest_manifest_entries(
+                            read_manifest_index(index, file.name,
+                                                cwd, out_cwd),
+                            groups, output_group)
+                else:
+                    result = ingest_manifest_lines(sep, file, file.name,
+                                                   cwd, groups,
+                                                   out_cwd, output_group)
+            self.ingested[key] = result
+        # The caller modifies the lists.
+        selected, unselected, groups_seen = result
+        return list(selected), list(unselected), groups_seen
 
 
 class input_entry_action(input_action_base):
@@ -210,7 +380,89 @@ class input_entry_action(input_action_base):
             [entry + '\n'], namespace.entry_manifest, *args)
 
 
-def common_parse_args(parser):
+class tree_copier(object):
+    """Copies files, each the cheapest way that works: a hard link, else a
+reflink, else a copy done in the kernel where possible.  A method that
+fails as unsupported isn't tried again.  Many threads can use one copier.
+
+A destination that already exists with the same size as its source, and
+is no older, is left alone.  That's always right for content-addressed
+files like blobs, and right for anything a build only ever replaces."""
+
+    def __init__(self):
+        self.methods = [
+            ('linked', file_copy.link_file),
+            ('cloned', file_copy.clone_file),
+            ('copied', file_copy.copy_file),
+        ]
+
+    def copy(self, source, dest):
+        """Copy source to dest.  Returns 'skipped' or the name of the
+method that made the copy."""
+        try:
+            dest_st = os.stat(dest)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            source_st = os.stat(source)
+            if (dest_st.st_size == source_st.st_size and
+                dest_st.st_mtime >= source_st.st_mtime):
+                return 'skipped'
+        temp = stat_cache.temp_filename(dest)
+        try:
+            for name, method in list(self.methods):
+                try:
+                    method(source, temp)
+                except (IOError, OSError) as e:
+                    if (e.errno not in file_copy.COPY_FALLBACK_ERRNOS or
+                        method is file_copy.copy_file):
+                        raise
+                    if os.path.lexists(temp):
+                        os.remove(temp)
+                    try:
+                        self.methods.remove((name, method))
+                    except ValueError:
+                        # Another thread got there first.
+                        pass
+                    continue
+                os.rename(temp, dest)
+                return name
+        finally:
+            if os.path.lexists(temp):
+                os.remove(temp)
+
+
+def copy_tree(output_dir, files, jobs=1):
+    """Copy each source file in the `files` dictionary to its target name
+under `output_dir`, using `jobs` threads.  Returns a Counter of the results
+of tree_copier.copy."""
+    dirs = set(os.path.dirname(os.path.join(output_dir, target))
+               for target in files)
+    for dir in sorted(dirs):
+        try:
+            os.makedirs(dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise exc
+    copier = tree_copier()
+    def copy((target, source)):
+        result = copier.copy(source, os.path.join(output_dir, target))
+        tracing.add_counter('files ' + result)
+        return result
+    if jobs > 1 and len(files) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(copy, files.iteritems())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(copy, files.iteritems())
+    return Counter(results)
+
+
+def common_parse_args(parser, argv=None):
     parser.add_argument('--output', action='append', required=True,
                         metavar='FILE',
                         help='Output file')
@@ -253,8 +505,11 @@ def common_parse_args(parser):
     parser.add_argument('--separator', default='=',
                         metavar='SEP',
                         help='Use SEP between TARGET and SOURCE in entries')
+    parser.add_argument('--trace',
+                        metavar='FILE',
+                        help='Write a Chrome trace of the work done to FILE')
     # Replace each `@rspfile` with the arguments from the file, and iterate.
-    args = sys.argv[1:]
+    args = list(sys.argv[1:] if argv is None else argv)
     i = 0
     while i < len(args):
         if args[i][0] == '@':
@@ -271,6 +526,12 @@ def parse_args():
                         help='Output directory tree of copies, not manifest')
     parser.add_argument('--sources', action='store_true', default=False,
                         help='Write source file per line, not manifest entry')
+    parser.add_argument('--merkleroot', action='store_true', default=False,
+                        help=('Write ROOT=SOURCE lines naming each source' +
+                              ' file by its Merkle tree root'))
+    parser.add_argument('--merkle-cache',
+                        metavar='FILE',
+                        help='Persistent cache of Merkle tree roots')
     parser.add_argument('--contents',
                         action='store_true', default=False,
                         help='Replace each source file name with its contents')
@@ -291,17 +552,35 @@ def parse_args():
     parser.add_argument('--stamp',
                         metavar='FILE',
                         help='Touch FILE at the end.')
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=multiprocessing.cpu_count(),
+                        metavar='N',
+                        help=('Copy or hash up to N files in parallel for' +
+                              ' --copytree or --merkleroot'))
+    parser.add_argument('--stats', action='store_true',
+                        help='Print how --copytree copied the files')
     args = common_parse_args(parser)
     if args.copytree:
         if args.contents:
             parser.error('--copytree is incompatible with --contents')
         args.unique = True
         args.sources = True
+    if args.merkleroot:
+        if args.contents or args.copytree:
+            parser.error('--merkleroot is incompatible with --contents' +
+                         ' and --copytree')
+        args.sources = True
     return args
 
 
 def main():
+    start = tracing.now()
     args = parse_args()
+    if args.trace:
+        tracing.enable(args.trace, 'manifest.py %s' % args.output[-1])
+        tracing.add_span('parse_args', start)
+    if args.merkle_cache:
+        merkle.enable_cache(args.merkle_cache)
     output_sets = [(dict() if args.unique else set()) for file in args.output]
     for entry in getattr(args, 'selected', []):
         assert entry.group is not None, entry
@@ -317,19 +596,25 @@ def main():
             output_sets[entry.group].add(line)
     for output_filename, output_set in zip(args.output, output_sets):
         if args.copytree:
-            for target, source in output_set.iteritems():
-                try:
-                    os.makedirs(os.path.join(output_filename,
-                                             os.path.dirname(target)))
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:
-                        raise exc
-                shutil.copyfile(source, os.path.join(output_filename, target))
+            with tracing.span('copytree', output=output_filename):
+                counts = copy_tree(output_filename, output_set, args.jobs)
+            if args.stats:
+                print '%s: %s' % (output_filename, ', '.join(
+                    '%d %s' % (count, result)
+                    for result, count in sorted(counts.iteritems())))
         else:
-            with open(output_filename, 'w') as file:
-                file.write(''.join(sorted(
-                    line + '\n' for line in
-                    (output_set.itervalues() if args.unique else output_set))))
+            lines = (output_set.itervalues() if args.unique
+                     else output_set)
+            if args.merkleroot:
+                lines = list(lines)
+                with tracing.span('merkleroot', output=output_filename):
+                    roots = merkle.get_merkle_roots(lines, args.jobs)
+                lines = [root + args.separator + line
+                         for root, line in zip(roots, lines)]
+            with tracing.span('update_file', file=output_filename):
+                with open(output_filename, 'w') as file:
+                    file.write(''.join(sorted(line + '\n'
+                                              for line in lines)))
     if args.stamp:
         with open(args.stamp, 'w') as file:
             os.utime(file.name, None)
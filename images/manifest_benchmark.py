@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Benchmark manifest.py's --include, --exclude and --rewrite matching, and
+its reading of manifests written relative to another directory.
+
+This makes a synthetic manifest shaped like a system image's, applies a
+set of patterns like those the build passes to it both with the original
+one-fnmatch-per-pattern code (kept here as the reference) and with the
+compiled glob_set and manifest_rewriter, checks that the results are
+identical, and prints the time each took.  Likewise it reads the manifest
+as if from a sibling directory both with the original normpath and
+relpath of each line and with path_translator.
+"""
+
+import argparse
+import fnmatch
+import manifest
+import os
+import sys
+import time
+
+
+INCLUDE = ['bin/*', 'lib/*', 'data/*/meta/*', 'driver/*.so', 'boot/config']
+EXCLUDE = ['lib/*asan*', 'data/test*/*', 'bin/*_test', 'lib/ld.so.1']
+REWRITE = [
+    'bin/*={target}=stripped/{source}',
+    'lib/lib*.so=lib/{target}=gen/{source}',
+    'driver/*.so=driver/{target}={source}',
+    'boot/config=boot/config=obj/{source}',
+]
+
+DIRS = ['bin', 'lib', 'data', 'driver', 'boot', 'meta', 'test']
+
+
+# Returns a list of manifest_entry tuples for a synthetic manifest.
+def make_manifest(count):
+    lines = []
+    for i in xrange(count):
+        dir = DIRS[i % len(DIRS)]
+        if dir == 'data':
+            target = 'data/%s%d/meta/file%d' % (('test', 'pkg')[i % 3 != 0],
+                                                 i % 97, i)
+        elif dir == 'lib':
+            target = 'lib/lib%s%d.so' % (('asan', 'foo')[i % 5 != 0], i)
+        elif dir == 'bin':
+            target = 'bin/prog%d%s' % (i, ('_test', '')[i % 4 != 0])
+        elif dir == 'boot':
+            target = 'boot/config' if i % 11 == 0 else 'boot/file%d' % i
+        else:
+            target = '%s/file%d.so' % (dir, i)
+        lines.append('%s=obj/%s/%s\n' % (target, dir, os.path.basename(target)))
+    return list(manifest.read_manifest_lines('=', lines, 'bench.manifest',
+                                             '', ''))
+
+
+# The original matching code, for reference.
+def reference_filter(entries, include, exclude):
+    def matches(file, patterns):
+        return any(fnmatch.fnmatch(file, pattern) for pattern in patterns)
+    def included(entry):
+        if matches(entry.target, exclude):
+            return False
+        return not include or matches(entry.target, include)
+    return filter(included, entries)
+
+
+def reference_rewrite(sep, rewrites, entry):
+    for pattern, line in rewrites:
+        if fnmatch.fnmatchcase(entry.target, pattern):
+            [new_entry] = manifest.read_manifest_lines(
+                sep,
+                [line.format(**entry._asdict()) + '\n'], entry.manifest,
+                os.path.dirname(entry.manifest),
+                os.path.dirname(entry.manifest))
+            entry = new_entry._replace(group=entry.group)
+    return entry
+
+
+def reference_translate(manifest_cwd, result_cwd, entries):
+    return [os.path.relpath(os.path.normpath(os.path.join(manifest_cwd,
+                                                          entry.source)),
+                            result_cwd)
+            for entry in entries]
+
+
+def reference(entries):
+    rewrites = [rewrite.split('=', 1) for rewrite in REWRITE]
+    return [reference_rewrite('=', rewrites, entry)
+            for entry in reference_filter(entries, INCLUDE, EXCLUDE)]
+
+
+def compiled(entries):
+    include = manifest.get_glob_set(INCLUDE).matches
+    exclude = manifest.get_glob_set(EXCLUDE).matches
+    rewrite = manifest.manifest_rewriter('=', REWRITE)
+    return [rewrite(entry) for entry in entries
+            if not exclude(entry.target) and include(entry.target)]
+
+
+def translated(manifest_cwd, result_cwd, entries):
+    translate = manifest.get_path_translator(manifest_cwd, result_cwd)
+    return [translate(entry.source) for entry in entries]
+
+
+# Returns the best time of `repeat` runs of `func(entries)`, and its result.
+def measure(func, entries, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(entries)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+Benchmark manifest.py pattern matching on a synthetic manifest.
+''')
+    parser.add_argument('--entries', type=int, default=200000,
+                        metavar='N',
+                        help='Number of manifest entries')
+    parser.add_argument('--repeat', type=int, default=3,
+                        metavar='N',
+                        help='Report the best of N runs')
+    args = parser.parse_args()
+
+    entries = make_manifest(args.entries)
+    reference_time, reference_result = measure(reference, entries, args.repeat)
+    compiled_time, compiled_result = measure(compiled, entries, args.repeat)
+    if compiled_result != reference_result:
+        print 'MISMATCH: compiled patterns differ from the reference'
+        return 1
+    print '%d entries, %d selected' % (len(entries), len(compiled_result))
+    print 'reference: %.3fs' % reference_time
+    print 'compiled:  %.3fs (%.1fx)' % (compiled_time,
+                                        reference_time / compiled_time)
+
+    cwds = ('../zircon/build-x64', '.')
+    reference_time, reference_result = measure(
+        lambda entries: reference_translate(cwds[0], cwds[1], entries),
+        entries, args.repeat)
+    translated_time, translated_result = measure(
+        lambda entries: translated(cwds[0], cwds[1], entries),
+        entries, args.repeat)
+    if translated_result != reference_result:
+        print 'MISMATCH: translated paths differ from the reference'
+        return 1
+    print 'reference paths:  %.3fs' % reference_time
+    print 'translated paths: %.3fs (%.1fx)' % (
+        translated_time, reference_time / translated_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+A binary form of a `{group}target=source` manifest, for reading
+without parsing and for fast lookups by target.
+
+The file is a header, a table of group names, a table of fixed-size
+entries in the manifest's own order, a table of entry numbers sorted by
+target, and then a pool of strings:
+
+    header:  magic (8 bytes), count (u32), group_count (u32)
+    group:   offset (u32), size (u32): the group name in the pool
+    entry:   group (u32: 0 for none, else 1 + the group's number),
+             target_offset (u32), target_size (u32),
+             source_offset (u32), source_size (u32): strings in the pool
+    sorted:  entry number (u32), ordered by target and then entry number
+
+All integers are little-endian.  Identical strings share their pool space.
+Since the entries keep their order, duplicates and groups (including the
+empty group, `{}`), converting a manifest to an index and back gives back
+exactly the same text.  A reader can mmap the file, iterate over entries
+without splitting lines, and binary-search the sorted table for a target.
+
+manifest.py accepts an index anywhere it accepts a text --manifest file.
+"""
+
+import argparse
+import array
+import mmap
+import os
+import struct
+import sys
+
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
+
+MAGIC = 'MANIFST\x01'
+HEADER = struct.Struct('<8sII')
+GROUP = struct.Struct('<II')
+ENTRY = struct.Struct('<IIIII')
+SORTED = struct.Struct('<I')
+
+
+def format_index(entries):
+    """Return the index file contents for an iterable of (group, target,
+source) tuples, where the group is None for an entry without one."""
+    entries = list(entries)
+    pool = []
+    pool_offsets = {}
+    pool_size = [0]
+    def intern(string):
+        offset = pool_offsets.get(string)
+        if offset is None:
+            offset = pool_offsets[string] = pool_size[0]
+            pool.append(string)
+            pool_size[0] += len(string)
+        return offset, len(string)
+    group_ids = {None: 0}
+    groups = []
+    table = []
+    for group, target, source in entries:
+        group_id = group_ids.get(group)
+        if group_id is None:
+            groups.append(GROUP.pack(*intern(group)))
+            group_id = group_ids[group] = len(groups)
+        table.append(ENTRY.pack(group_id,
+                                *(intern(target) + intern(source))))
+    by_target = sorted(xrange(len(entries)),
+                       key=lambda i: (entries[i][1], i))
+    return ''.join([HEADER.pack(MAGIC, len(entries), len(groups))] +
+                   groups + table +
+                   [SORTED.pack(i) for i in by_target] +
+                   pool)
+
+
+def write_index(filename, entries):
+    """Write the index for (group, target, source) tuples to the file,
+unless it already has identical contents.  Returns True iff it was written."""
+    return write_if_changed.write_file(filename, format_index(entries))
+
+
+def is_manifest_index(file):
+    """Return True if the open file is an index rather than a text manifest.
+The file is left at its start."""
+    magic = file.read(len(MAGIC))
+    file.seek(0)
+    return magic == MAGIC
+
+
+class manifest_index(object):
+    """A reader for an index file, which it maps into memory.
+Use it in a `with` statement to unmap it at the end."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError('%s: not a manifest index' % filename)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, group_count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s: not a manifest index' % filename)
+        self._entries = HEADER.size + group_count * GROUP.size
+        self._sorted = self._entries + self.count * ENTRY.size
+        self._pool = self._sorted + self.count * SORTED.size
+        # There are few groups, so they are all read up front.
+        self.groups = [None] + [
+            self._string(*GROUP.unpack_from(self._map,
+                                            HEADER.size + i * GROUP.size))
+            for i in xrange(group_count)]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, offset, size):
+        offset += self._pool
+        return self._map[offset:offset + size]
+
+    def entry(self, i):
+        """Return the (group, target, source) tuple for entry number `i`."""
+        (group, target_offset, target_size,
+         source_offset, source_size) = ENTRY.unpack_from(
+             self._map, self._entries + i * ENTRY.size)
+        return (self.groups[group],
+                self._string(target_offset, target_size),
+                self._string(source_offset, source_size))
+
+    def _sorted_entry(self, i):
+        return SORTED.unpack_from(self._map, self._sorted + i * SORTED.size)[0]
+
+    def _target(self, i):
+        target_offset, target_size = ENTRY.unpack_from(
+            self._map, self._entries + i * ENTRY.size)[1:3]
+        return self._string(target_offset, target_size)
+
+    def lookup(self, target):
+        """Return the list of (group, target, source) tuples for the entries
+with the given target, in manifest order."""
+        # Find the first sorted entry not less than target.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._target(self._sorted_entry(mid)) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < self.count:
+            i = self._sorted_entry(lo)
+            if self._target(i) != target:
+                break
+            result.append(self.entry(i))
+            lo += 1
+        return result
+
+    def __iter__(self):
+        """Yield (group, target, source) tuples in manifest order."""
+        # Reading the whole entry table and pool at once is much faster
+        # than unpacking each entry.
+        table = array.array('I', self._map[self._entries:self._sorted])
+        if sys.byteorder != 'little':
+            table.byteswap()
+        pool = self._map[self._pool:]
+        groups = self.groups
+        for i in xrange(0, len(table), 5):
+            target = table[i + 1]
+            source = table[i + 3]
+            yield (groups[table[i]],
+                   pool[target:target + table[i + 2]],
+                   pool[source:source + table[i + 4]])
+
+
+# Module public API.
+__all__ = ['format_index', 'is_manifest_index', 'manifest_index',
+           'write_index']
+
+
+def main():
+    import manifest
+
+    parser = argparse.ArgumentParser(description='''
+Convert text manifests to a binary index, convert an index back to text,
+or look up targets in an index.
+''')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        help='Write an index of the input manifests')
+    parser.add_argument('--text',
+                        metavar='FILE',
+                        help='Print the index FILE as a text manifest')
+    parser.add_argument('--lookup',
+                        metavar='FILE',
+                        help='Print the entries for each target argument')
+    parser.add_argument('--separator', default='=',
+                        metavar='SEP',
+                        help='Use SEP between TARGET and SOURCE in entries')
+    parser.add_argument('inputs', nargs='*',
+                        metavar='INPUT',
+                        help='Text manifest file, or target with --lookup')
+    args = parser.parse_args()
+    if len(filter(None, [args.output, args.text, args.lookup])) != 1:
+        parser.error('need exactly one of --output, --text or --lookup')
+
+    def format_entries(entries):
+        return ''.join(manifest.format_manifest_line(args.separator, *entry) +
+                       '\n' for entry in entries)
+
+    if args.output:
+        entries = []
+        for input in args.inputs:
+            with open(input, 'r') as file:
+                for line in file:
+                    assert line.endswith('\n'), (
+                        "Unterminated manifest line: %r" % line)
+                    entries.append(manifest.split_manifest_line(
+                        args.separator, line[:-1]))
+        write_index(args.output, entries)
+    elif args.text:
+        if args.inputs:
+            parser.error('--text takes no other arguments')
+        with manifest_index(args.text) as index:
+            sys.stdout.write(format_entries(index))
+    else:
+        status = 0
+        with manifest_index(args.lookup) as index:
+            for target in args.inputs:
+                entries = index.lookup(target)
+                if not entries:
+                    sys.stderr.write('%s: not found\n' % target)
+                    status = 1
+                sys.stdout.write(format_entries(entries))
+        return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
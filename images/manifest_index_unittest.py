@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from manifest import format_manifest_line, split_manifest_line
+from manifest_index import (format_index, is_manifest_index, manifest_index,
+                            write_index)
+
+
+MANIFEST = '''\
+bin/app=obj/app
+{core}lib/libc.so=obj/libc.so
+{}data/empty-group=obj/data
+lib/libc.so=obj/other/libc.so
+bin/app=obj/app
+{misc}zzz/last=obj/last
+aaa/first=obj/first
+'''
+
+
+class ManifestIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = os.path.join(self.dir, 'test.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entries(self):
+        return [split_manifest_line('=', line)
+                for line in MANIFEST.splitlines()]
+
+    def test_round_trip(self):
+        self.assertTrue(write_index(self.index, self.entries()))
+        self.assertFalse(write_index(self.index, self.entries()))
+        with manifest_index(self.index) as index:
+            self.assertEqual(len(index), 7)
+            self.assertEqual(index.groups, [None, 'core', '', 'misc'])
+            self.assertEqual(''.join(format_manifest_line('=', *entry) + '\n'
+                                     for entry in index),
+                             MANIFEST)
+            self.assertEqual([index.entry(i) for i in xrange(len(index))],
+                             list(index))
+
+    def test_lookup(self):
+        write_index(self.index, self.entries())
+        with manifest_index(self.index) as index:
+            self.assertEqual(index.lookup('aaa/first'),
+                             [(None, 'aaa/first', 'obj/first')])
+            self.assertEqual(index.lookup('zzz/last'),
+                             [('misc', 'zzz/last', 'obj/last')])
+            # Duplicates come back in manifest order.
+            self.assertEqual(index.lookup('lib/libc.so'),
+                             [('core', 'lib/libc.so', 'obj/libc.so'),
+                              (None, 'lib/libc.so', 'obj/other/libc.so')])
+            self.assertEqual(index.lookup('bin/app'),
+                             [(None, 'bin/app', 'obj/app')] * 2)
+            for target in ['', 'aaa', 'bin/app2', 'lib', 'zzz/last/x', '~']:
+                self.assertEqual(index.lookup(target), [], target)
+
+    def test_bad_magic(self):
+        contents = format_index(self.entries())
+        for bad in ['MANIFST\x02' + contents[8:], 'BUILDID\x01' + contents[8:],
+                    contents[:4]]:
+            with open(self.index, 'wb') as f:
+                f.write(bad)
+            with open(self.index, 'rb') as f:
+                self.assertFalse(is_manifest_index(f))
+            with self.assertRaises(ValueError):
+                manifest_index(self.index)
+
+    def test_manifest_py(self):
+        text = os.path.join(self.dir, 'test.manifest')
+        with open(text, 'w') as f:
+            f.write(MANIFEST)
+        write_index(self.index, self.entries())
+        manifest_py = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'manifest.py')
+        outputs = []
+        for input in [text, self.index]:
+            output = input + '.out'
+            subprocess.check_call([sys.executable, manifest_py,
+                                   '--output=' + output,
+                                   '--groups=core',
+                                   '--manifest=' + input])
+            with open(output) as f:
+                outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('lib/libc.so=', outputs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Merge sorted `ids.txt` build ID maps into one.
+
+Each input must already be sorted, as finalize_manifests.py writes them.
+The inputs are merged as streams rather than read and sorted as a whole,
+and the merged pairs are already in the order build_id_index.py needs.
+Identical lines are written once.  A build ID that maps to two
+different file names is a conflict: each one is reported, and it is an
+error unless --allow-conflicts is given, in which case the first name in
+sorted order is kept.
+
+The output is only replaced if its contents change, so that Ninja can
+skip whatever depends on it.
+"""
+
+import argparse
+import build_id_index
+import heapq
+import os
+import sys
+
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
+
+# Yields (build ID, file name) pairs from the ids.txt file `filename`,
+# checking that they are sorted.
+def read_sorted_ids_txt(filename):
+    with open(filename, 'r') as file:
+        last = None
+        for lineno, pair in enumerate(build_id_index.read_ids_txt(file), 1):
+            if last is not None and pair < last:
+                raise ValueError('%s:%d: not sorted' % (filename, lineno))
+            last = pair
+            yield pair
+
+
+def merge_ids(filenames, conflicts):
+    """Yield the (build ID, file name) pairs from the sorted ids.txt files,
+in sorted order with duplicates elided.  When a build ID has more than one
+file name, only the first is yielded, and (build ID, [file names]) is
+appended to the `conflicts` list."""
+    last_id = None
+    names = None
+    for build_id, filename in heapq.merge(*map(read_sorted_ids_txt,
+                                               filenames)):
+        if build_id == last_id:
+            if filename != names[-1]:
+                if len(names) == 1:
+                    conflicts.append((build_id, names))
+                names.append(filename)
+            continue
+        last_id = build_id
+        names = [filename]
+        yield build_id, filename
+
+
+def write_ids_txt(filename, pairs):
+    """Write the (build ID, file name) pairs to the file, unless it already
+has identical contents.  Returns True iff it was written."""
+    return write_if_changed.write_file(
+        filename, ''.join('%s %s\n' % pair for pair in pairs))
+
+
+# Module public API.
+__all__ = ['merge_ids', 'write_ids_txt']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+Merge sorted ids.txt build ID maps, reporting conflicting entries.
+''')
+    parser.add_argument('--output', required=True,
+                        metavar='FILE',
+                        help='Write the merged ids.txt file')
+    parser.add_argument('--index',
+                        metavar='FILE',
+                        help='Also write the build_id_index.py index')
+    parser.add_argument('--allow-conflicts', action='store_true',
+                        default=False,
+                        help='Keep the first file name for a conflicting ' +
+                        'build ID rather than failing')
+    parser.add_argument('inputs', nargs='*',
+                        metavar='INPUT',
+                        help='Sorted ids.txt file')
+    args = parser.parse_args()
+
+    conflicts = []
+    try:
+        pairs = merge_ids(args.inputs, conflicts)
+        if args.index:
+            # The ids.txt file is written from the same pairs.
+            pairs = list(pairs)
+            build_id_index.write_index(args.index, pairs)
+        write_ids_txt(args.output, pairs)
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+
+    for build_id, names in conflicts:
+        sys.stderr.write('%s: build ID %s is %s\n' %
+                         ('WARNING' if args.allow_conflicts else 'ERROR',
+                          build_id, ' and '.join(names)))
+    if conflicts and not args.allow_conflicts:
+        # Don't leave outputs that look up to date.
+        for output in [args.output, args.index]:
+            if output:
+                os.remove(output)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import build_id_index
+import merge_build_ids
+
+
+class MergeBuildIdsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Returns the name of a new file in the temporary directory.
+    def write(self, name, contents):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    # Runs merge_build_ids.py with the arguments and returns its exit
+    # status and what it wrote to stderr.
+    def run_main(self, *args):
+        old_argv, old_stderr = sys.argv, sys.stderr
+        sys.argv = ['merge_build_ids.py'] + list(args)
+        sys.stderr = StringIO.StringIO()
+        try:
+            return merge_build_ids.main(), sys.stderr.getvalue()
+        finally:
+            sys.argv, sys.stderr = old_argv, old_stderr
+
+    def test_merge(self):
+        inputs = [self.write('a.txt', '01 lib/a.so\n0a bin/c\n'),
+                  self.write('b.txt', '02 lib/b.so\n')]
+        output = os.path.join(self.dir, 'ids.txt')
+        index = os.path.join(self.dir, 'ids.idx')
+        self.assertEqual(self.run_main('--output', output, '--index', index,
+                                       *inputs),
+                         (0, ''))
+        self.assertEqual(self.read('ids.txt'),
+                         '01 lib/a.so\n02 lib/b.so\n0a bin/c\n')
+        with build_id_index.build_id_index(index) as reader:
+            self.assertEqual(list(reader), [('01', 'lib/a.so'),
+                                            ('02', 'lib/b.so'),
+                                            ('0a', 'bin/c')])
+
+    def test_duplicates_elided(self):
+        inputs = [self.write('a.txt', '01 lib/a.so\n02 lib/b.so\n'),
+                  self.write('b.txt', '01 lib/a.so\n02 lib/b.so\n')]
+        conflicts = []
+        self.assertEqual(list(merge_build_ids.merge_ids(inputs, conflicts)),
+                         [('01', 'lib/a.so'), ('02', 'lib/b.so')])
+        self.assertEqual(conflicts, [])
+
+    def test_conflict(self):
+        inputs = [self.write('a.txt', '01 lib/a.so\n'),
+                  self.write('b.txt', '01 lib/other.so\n')]
+        output = os.path.join(self.dir, 'ids.txt')
+        index = os.path.join(self.dir, 'ids.idx')
+        status, errors = self.run_main('--output', output, '--index', index,
+                                       *inputs)
+        self.assertEqual(status, 1)
+        self.assertEqual(errors,
+                         'ERROR: build ID 01 is lib/a.so and lib/other.so\n')
+        self.assertFalse(os.path.exists(output))
+        self.assertFalse(os.path.exists(index))
+
+    def test_allow_conflicts(self):
+        inputs = [self.write('a.txt', '01 lib/other.so\n'),
+                  self.write('b.txt', '01 lib/a.so\n')]
+        output = os.path.join(self.dir, 'ids.txt')
+        status, errors = self.run_main('--output', output,
+                                       '--allow-conflicts', *inputs)
+        self.assertEqual(status, 0)
+        self.assertEqual(errors,
+                         'WARNING: build ID 01 is lib/a.so and lib/other.so\n')
+        self.assertEqual(self.read('ids.txt'), '01 lib/a.so\n')
+
+    def test_unsorted(self):
+        inputs = [self.write('a.txt', '02 lib/b.so\n01 lib/a.so\n')]
+        with self.assertRaises(ValueError) as context:
+            list(merge_build_ids.merge_ids(inputs, []))
+        self.assertEqual(str(context.exception), inputs[0] + ':2: not sorted')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+The Merkle tree root digests that blobfs uses to name blobs.
+
+The data is divided into 8 KiB blocks.  Each block's SHA-256 digest covers
+a little-endian 64-bit word combining the block's offset within its level
+and the level number, a little-endian 32-bit length, and the block's data
+padded with zeros to the full block size.  The digests of one level,
+concatenated, are the data of the next level up, until a level has just
+one digest: the root.  The length is that of the data in the blocks of the
+file itself (level 0), but always the full block size in the levels above.
+Empty data has the digest of one empty block, which is not padded.
+
+Files are hashed over mmap.  hashlib lets other threads run while it
+hashes each block, so many files can be hashed in parallel by threads.
+With `enable_cache`, the roots are kept in a stat_cache.stat_cache, so an
+unchanged file is never hashed again.
+"""
+
+from multiprocessing.pool import ThreadPool
+import argparse
+import atexit
+import binascii
+import hashlib
+import mmap
+import multiprocessing
+import os
+import stat_cache
+import struct
+
+
+BLOCK_SIZE = 8192
+BLOCK_HEADER = struct.Struct('<QI')
+ZEROS = '\0' * BLOCK_SIZE
+
+
+def hash_block(data, offset, level):
+    """Return the digest of one block of `data` (at most BLOCK_SIZE bytes)."""
+    # Blocks of digests count as padded to the full size.
+    length = len(data) if level == 0 else BLOCK_SIZE
+    hash = hashlib.sha256(BLOCK_HEADER.pack(offset | level, length))
+    if data:
+        hash.update(data)
+        hash.update(ZEROS[len(data):])
+    return hash.digest()
+
+
+def merkle_root(data):
+    """Return the root digest for `data` (a string or an mmap) as raw bytes."""
+    level = 0
+    while True:
+        digests = [hash_block(buffer(data, offset, BLOCK_SIZE), offset, level)
+                   for offset in xrange(0, max(len(data), 1), BLOCK_SIZE)]
+        if len(digests) == 1:
+            return digests[0]
+        data = ''.join(digests)
+        level += 1
+
+
+def read_merkle_root(filename):
+    """Return the root digest of the file's contents in hex."""
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # An empty file can't be mapped.
+            return binascii.hexlify(merkle_root(''))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return binascii.hexlify(merkle_root(mapped))
+    finally:
+        mapped.close()
+
+
+# The version of the hex root digests stored in the cache.
+MERKLE_CACHE_VERSION = 2
+
+# When enabled, this is a stat_cache.stat_cache of hex root digests.
+_cache = None
+
+def enable_cache(filename):
+    """Make get_merkle_root use a persistent cache in the given file.
+The cache is saved when the process exits."""
+    global _cache
+    if _cache is None:
+        _cache = stat_cache.stat_cache(filename, MERKLE_CACHE_VERSION)
+        atexit.register(_cache.save)
+    return _cache
+
+
+def get_merkle_root(filename):
+    """Return the root digest of the file's contents in hex."""
+    if _cache is None:
+        return read_merkle_root(filename)
+    return _cache.get(filename, read_merkle_root)
+
+
+def get_merkle_roots(filenames, jobs=1):
+    """Return a list of the hex root digests of the files, hashing up to
+`jobs` files at once."""
+    filenames = list(filenames)
+    if jobs > 1 and len(filenames) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(get_merkle_root, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    return map(get_merkle_root, filenames)
+
+
+# Module public API.
+__all__ = ['enable_cache', 'get_merkle_root', 'get_merkle_roots',
+           'merkle_root']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print ROOT=FILE for each file\'s Merkle tree root.')
+    parser.add_argument('--cache',
+                        metavar='FILE',
+                        help='Persistent cache of Merkle tree roots')
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=multiprocessing.cpu_count(),
+                        metavar='N',
+                        help='Hash up to N files in parallel')
+    parser.add_argument('files', nargs='+',
+                        metavar='FILE',
+                        help='File to hash')
+    args = parser.parse_args()
+    if args.cache:
+        enable_cache(args.cache)
+    for filename, root in zip(args.files,
+                              get_merkle_roots(args.files, args.jobs)):
+        print '%s=%s' % (root, filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import binascii
+import os
+import shutil
+import tempfile
+import unittest
+
+from merkle import get_merkle_roots, merkle_root
+
+
+# Merkle tree roots that blobfs computes for the given data.
+VECTORS = [
+    ('', '15ec7bf0b50732b49f8228e07d24365338f9e3ab994b00af08e5a3bffe55fd8b'),
+    ('\xff' * 8192,
+     '68d131bc271f9c192d4f6dcd8fe61bef90004856da19d0f2f514a7f4098b0737'),
+    ('\xff' * 8193,
+     '374781f7d770b6ee9c1a63e186d2d0ccdad10d6aef4fd027e82b1be5b70a2a0c'),
+    ('\xff' * 65536,
+     'f75f59a944d2433bc6830ec243bfefa457704d2aed12f30539cd4f18bf1d62cf'),
+]
+
+
+class MerkleTests(unittest.TestCase):
+
+    def test_merkle_root(self):
+        for data, root in VECTORS:
+            self.assertEqual(binascii.hexlify(merkle_root(data)), root,
+                             '%d bytes' % len(data))
+
+    def test_get_merkle_roots(self):
+        dir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i, (data, root) in enumerate(VECTORS):
+                filename = os.path.join(dir, str(i))
+                with open(filename, 'wb') as f:
+                    f.write(data)
+                filenames.append(filename)
+            self.assertEqual(get_merkle_roots(filenames, 2),
+                             [root for data, root in VECTORS])
+        finally:
+            shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+A persistent cache of values derived from file contents.
+
+Each value is keyed by the identity of the file it was computed from, as
+seen by stat: (st_dev, st_ino, st_size, st_mtime in nanoseconds).  So a
+lookup costs one stat call, and any rewrite of the file naturally misses.
+
+The cache lives in a single file that many processes (e.g. parallel Ninja
+actions) share.  Each process reads it once when first used and merges
+its new entries back at exit under an exclusive lock, replacing the file
+atomically so that readers never need the lock.
+
+Each user of a cache gives the version of the format of its values, which
+the file records.  A cache file written with any other version is treated
+as empty, so bumping one user's version never affects another's cache.
+"""
+
+from contextlib import contextmanager
+import cPickle
+import errno
+import fcntl
+import os
+import threading
+import time
+
+
+# Entries not used in this long are dropped when the cache is saved.
+DEFAULT_MAX_AGE = 14 * 24 * 60 * 60
+
+# When there are more entries than this, the least recently used go first.
+DEFAULT_MAX_ENTRIES = 200000
+
+# A hit only refreshes an entry's last-used time (and so dirties the cache)
+# if the recorded time is older than this.
+REFRESH_INTERVAL = 60 * 60
+
+
+def stat_key(st):
+    """Return the cache key tuple for an os.stat result."""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+def file_key(filename):
+    return stat_key(os.stat(filename))
+
+
+@contextmanager
+def locked(filename):
+    """A context manager that holds an exclusive lock on `filename`.lock."""
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def temp_filename(filename):
+    """Return a name next to `filename` for writing it before a rename.
+The name is unique to the process and thread."""
+    return os.path.join(os.path.dirname(filename),
+                        '.%s.%d.%d.tmp' % (os.path.basename(filename),
+                                           os.getpid(),
+                                           threading.current_thread().ident))
+
+
+def replace_file(filename, contents, mode=0666):
+    """Atomically replace `filename` with `contents`."""
+    tmp = temp_filename(filename)
+    try:
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               mode), 'wb') as f:
+            f.write(contents)
+        os.rename(tmp, filename)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+class stat_cache(object):
+    """Cache of `compute(filename)` results keyed by the file's stat_key.
+The `version` identifies the format of the values; bump it whenever that
+changes.
+
+Entries are (filename, value, last_used) tuples.  An entry is stale, and
+evicted, when a newer entry for the same file name is stored, when it has
+not been used in `max_age` seconds, or when the cache holds more than
+`max_entries` and it is among the least recently used."""
+
+    def __init__(self, filename, version, max_age=DEFAULT_MAX_AGE,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.version = version
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = {}
+
+    def _read(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = cPickle.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            # A corrupt or truncated cache is just an empty one.
+            return {}
+        if (not isinstance(data, tuple) or len(data) != 2 or
+            data[0] != self.version):
+            return {}
+        return data[1]
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, filename, compute):
+        try:
+            key = file_key(filename)
+        except OSError as e:
+            # Fail the way compute would, by not being able to open it.
+            raise IOError(e.errno, e.strerror, filename)
+        now = int(time.time())
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is not None:
+                self.hits += 1
+                if now - entry[2] > REFRESH_INTERVAL:
+                    entry = (entry[0], entry[1], now)
+                    self._entries[key] = self._dirty[key] = entry
+                return entry[1]
+            self.misses += 1
+        # Compute outside the lock so other threads can proceed meanwhile.
+        value = compute(filename)
+        with self._lock:
+            self._entries[key] = self._dirty[key] = (filename, value, now)
+        return value
+
+    def _evict(self, entries, now):
+        # Keep only the newest entry for each file name.
+        newest = {}
+        for key, (filename, value, last_used) in entries.iteritems():
+            other = newest.get(filename)
+            if other is None or other[3] < key[3]:
+                newest[filename] = key
+        live = [(key, entry) for key, entry in entries.iteritems()
+                if (newest[entry[0]] == key and
+                    now - entry[2] <= self.max_age)]
+        if len(live) > self.max_entries:
+            live.sort(key=lambda (key, entry): entry[2], reverse=True)
+            del live[self.max_entries:]
+        self.evictions += len(entries) - len(live)
+        return dict(live)
+
+    def save(self):
+        """Merge new entries into the cache file.  Returns True iff written."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            with locked(self.filename):
+                # Another process might have saved since we read the file.
+                entries = self._read()
+                entries.update(self._dirty)
+                entries = self._evict(entries, int(time.time()))
+                replace_file(self.filename,
+                             cPickle.dumps((self.version, entries),
+                                           cPickle.HIGHEST_PROTOCOL))
+            self._entries = entries
+            self._dirty = {}
+            return True
+
+    def stats(self):
+        return ('%s: %d hits, %d misses, %d evictions' %
+                (self.filename, self.hits, self.misses, self.evictions))
+
+
+# Module public API.
+__all__ = ['file_key', 'replace_file', 'stat_cache', 'stat_key',
+           'temp_filename']
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Trace output for the image build scripts, in the Chrome trace event JSON
+format that chrome://tracing and Perfetto display.
+
+Events carry absolute timestamps (microseconds since the epoch) and the
+real process and thread IDs, so the traces written by separate processes
+merge into one timeline just by combining their event lists.  Use
+`tracing.py --output=FILE TRACE...` to do that.
+
+Nothing is recorded unless `enable` has been called, so the `span` and
+`add_counter` calls that instrument the scripts cost little otherwise.
+"""
+
+from contextlib import contextmanager
+import argparse
+import atexit
+import json
+import os
+import stat_cache
+import sys
+import threading
+import time
+
+
+def now():
+    """Return the current time as a trace timestamp."""
+    return int(time.time() * 1000000)
+
+
+class tracer(object):
+    """Collects the events for one trace file, which `write` writes."""
+
+    def __init__(self, filename, label):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.events = [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': label},
+        }]
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def complete(self, name, start, end, args):
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+    def add_counter(self, name, value):
+        with self._lock:
+            total = self.counters.get(name, 0) + value
+            self.counters[name] = total
+            self.events.append({
+                'name': name,
+                'ph': 'C',
+                'ts': now(),
+                'pid': self.pid,
+                'args': {name: total},
+            })
+
+    def write(self):
+        stat_cache.replace_file(self.filename, json.dumps({
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+        }, sort_keys=True) + '\n')
+
+
+# When enabled, this is the tracer.
+_tracer = None
+
+def enable(filename, label=None):
+    """Record events from now on, and write them to `filename` when the
+process exits.  Only the first call in a process has any effect.  The
+`label` names the process in the timeline."""
+    global _tracer
+    if _tracer is None:
+        _tracer = tracer(filename,
+                         label or os.path.basename(sys.argv[0]))
+        atexit.register(_tracer.write)
+    return _tracer
+
+
+@contextmanager
+def span(name, **args):
+    """A context manager that records its body as a span named `name`,
+with `args` as the details shown for it."""
+    if _tracer is None:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        _tracer.complete(name, start, now(), args)
+
+
+def add_span(name, start, **args):
+    """Record a span from the `start` timestamp until now.  This is for
+work done before the trace could be enabled, like parsing arguments."""
+    if _tracer is not None:
+        _tracer.complete(name, start, now(), args)
+
+
+def add_counter(name, value=1):
+    """Add `value` to the counter `name`, recording its new total."""
+    if _tracer is not None:
+        _tracer.add_counter(name, value)
+
+
+def merge(filenames):
+    """Return the trace JSON object combining the given trace files."""
+    events = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            events += json.load(f)['traceEvents']
+    # Metadata events have no timestamp and sort first.
+    events.sort(key=lambda event: event.get('ts', 0))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+# Module public API.
+__all__ = ['add_counter', 'add_span', 'enable', 'merge', 'now', 'span']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge trace files into one timeline.')
+    parser.add_argument('--output', required=True,
+                        metavar='FILE',
+                        help='Merged trace file to write')
+    parser.add_argument('traces', nargs='+',
+                        metavar='TRACE',
+                        help='Trace file written via --trace')
+    args = parser.parse_args()
+    stat_cache.replace_file(args.output,
+                            json.dumps(merge(args.traces), sort_keys=True) +
+                            '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,10 @@
 
 from collections import namedtuple
 import elfinfo
+import errno
 import glob
 import os
+import threading
 
 
 # Copied from //zircon/system/public/zircon/driver/binding.h, which see.
@@ -54,6 +56,31 @@ def make_variant(name, info):
     return variant(tc, libprefix, runtime, aux)
 
 
+# This maps (abs build_dir, directory) to the set of names in that
+# directory, so each is listed only once per process.
+_listings = {}
+_listings_lock = threading.Lock()
+
+
+# Returns the set of names in `directory` under `build_dir`, which is empty
+# if there is no such directory.  Only that one directory is listed, not
+# its subdirectories.
+def list_build_dir(build_dir, directory):
+    key = (os.path.abspath(build_dir), os.path.normpath(directory))
+    with _listings_lock:
+        names = _listings.get(key)
+        if names is None:
+            try:
+                names = frozenset(os.listdir(os.path.join(build_dir,
+                                                          directory)))
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                names = frozenset()
+            _listings[key] = names
+    return names
+
+
 def find_variant(info, build_dir=os.path.curdir):
     variant = None
     variant_file = None
@@ -71,13 +98,18 @@ def find_variant(info, build_dir=os.path.curdir):
             # subdirectory is found.  Below, we'll change the name but not
             # call it a variant.
             rel_filename = os.path.relpath(abs_filename, abs_build_dir)
+            rel_dir, name = os.path.split(rel_filename)
             variant_prefix = info.cpu.gn + '-'
             subdirs = [subdir
-                       for subdir in os.listdir(build_dir)
+                       for subdir in sorted(list_build_dir(build_dir,
+                                                           os.curdir))
                        if (subdir.startswith(variant_prefix) and
-                           os.path.exists(os.path.join(subdir, rel_filename)))]
+                           name in list_build_dir(build_dir,
+                                                  os.path.join(subdir,
+                                                               rel_dir)))]
             files = [os.path.join(subdir, rel_filename) for subdir in subdirs]
-            assert all(os.path.samestat(os.stat(file), file_stat)
+            assert all(os.path.samestat(os.stat(os.path.join(build_dir, file)),
+                                        file_stat)
                        for file in files), (
                 "Not all %r matches are hard links: %r" % (info, files))
             # Rust binaries have multiple links but are not variants.
@@ -19,9 +19,11 @@ pub //garnet/public/lib/ui/views/fidl/views.fidl: //garnet/public/lib/media/fidl
 """
 
 import ast
+import cStringIO
 import optparse
 import os
 import sys
+import write_if_changed
 import zipfile
 
 # for some reason, gn seems to tack on an extra element in the directory
@@ -54,7 +56,7 @@ def handle_map_deps(o, depsmap, covered, target, is_public):
 
 def make_map(output, sources, map_deps, map_public_deps, target):
   target = fix_label(target)
-  o = file(output, 'w')
+  o = cStringIO.StringIO()
   covered = set()
   for i in sources:
     covered.add(i)
@@ -64,6 +66,7 @@ def make_map(output, sources, map_deps, map_public_deps, target):
     handle_map_deps(o, m, covered, target, False)
   for m in map_public_deps:
     handle_map_deps(o, m, covered, target, True)
+  write_if_changed.write_file(output, o.getvalue())
 
 def main():
   parser = optparse.OptionParser()
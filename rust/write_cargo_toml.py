@@ -4,7 +4,6 @@
 # found in the LICENSE file.
 
 import argparse
-import datetime
 import json
 import os
 import subprocess
@@ -13,6 +12,8 @@ import sys
 ROOT_PATH = os.path.abspath(__file__ + "/../../..")
 sys.path += [os.path.join(ROOT_PATH, "third_party", "pytoml")]
 import pytoml
+sys.path += [os.path.join(ROOT_PATH, "build")]
+import write_if_changed
 
 # List of packages that are part of the third-party build
 # that live in-tree. In order to unify the two packages in builds
@@ -44,8 +45,9 @@ name = "%(crate_name)s"%(lib_crate_type)s
 path = "%(source_root)s"
 '''
 
-def cur_year():
-    return datetime.datetime.now().year
+# The copyright year is fixed so that the output doesn't depend on when
+# it's generated.
+COPYRIGHT_YEAR = 2018
 
 def main():
     parser = argparse.ArgumentParser("Writes a Cargo.toml for a Rust crate")
@@ -109,31 +111,30 @@ def main():
                         "version": dep_data["version"],
                     }
 
-    with open(cargo_toml_path, "w") as file:
-        file.write(CARGO_TOML_CONTENTS % {
-            "package_name": args.package_name,
-            "crate_name": args.crate_name,
-            "version": args.version,
-            "edition": args.edition,
-            "deps": deps,
-            "year": cur_year(),
-            "bin_or_lib": "[[bin]]" if args.crate_type == "bin" else "[lib]",
-            "lib_crate_type": "" if args.crate_type == "bin" else (
-                '\ncrate_type = ["%s"]' % args.crate_type
-            ),
-            "source_root": args.source_root,
-        })
-        dependencies = { "dependencies": deps }
-        file.write(pytoml.dumps({
-            "dependencies": deps,
-            "patch": { "crates-io": third_party_json["patches"] },
-        }))
-
-        profile = { "profile": { "release": { "panic" : "abort", "opt-level": "z" } } }
-        if args.lto and args.lto != "none":
-            profile["profile"]["release"]["lto"] = args.lto
-
-        file.write(pytoml.dumps(profile))
+    contents = CARGO_TOML_CONTENTS % {
+        "package_name": args.package_name,
+        "crate_name": args.crate_name,
+        "version": args.version,
+        "edition": args.edition,
+        "deps": deps,
+        "year": COPYRIGHT_YEAR,
+        "bin_or_lib": "[[bin]]" if args.crate_type == "bin" else "[lib]",
+        "lib_crate_type": "" if args.crate_type == "bin" else (
+            '\ncrate_type = ["%s"]' % args.crate_type
+        ),
+        "source_root": args.source_root,
+    }
+    contents += pytoml.dumps({
+        "dependencies": deps,
+        "patch": { "crates-io": third_party_json["patches"] },
+    })
+
+    profile = { "profile": { "release": { "panic" : "abort", "opt-level": "z" } } }
+    if args.lto and args.lto != "none":
+        profile["profile"]["release"]["lto"] = args.lto
+
+    contents += pytoml.dumps(profile)
+    write_if_changed.write_file(cargo_toml_path, contents)
 
 if __name__ == '__main__':
     sys.exit(main())
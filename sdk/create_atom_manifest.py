@@ -4,12 +4,15 @@
 # found in the LICENSE file.
 
 import argparse
-import json
 import os
 import sys
 
 from sdk_common import Atom, detect_category_violations, detect_collisions, gather_dependencies
 
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -70,8 +73,7 @@ def main():
         'atoms': map(lambda a: a.json, sorted(list(atoms))),
     }
 
-    with open(os.path.abspath(args.out), 'w') as out:
-        json.dump(manifest, out, indent=2, sort_keys=True)
+    write_if_changed.write_json(os.path.abspath(args.out), manifest)
 
 
 if __name__ == '__main__':
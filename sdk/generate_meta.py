@@ -5,10 +5,15 @@
 
 import argparse
 import json
+import os
 import sys
 
 from sdk_common import Atom
 
+BUILD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [BUILD_DIR]
+import write_if_changed
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -40,8 +45,7 @@ def main():
         'parts': sorted(filter(lambda m: m, [a.metadata for a in atoms])),
     }
 
-    with open(args.meta, 'w') as meta_file:
-        json.dump(meta, meta_file, indent=2, sort_keys=True)
+    write_if_changed.write_json(args.meta, meta)
 
 
 if __name__ == '__main__':
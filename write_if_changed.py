@@ -0,0 +1,55 @@
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Writes build outputs only when their contents change.
+
+Ninja's restat checks an action's outputs after it runs, and skips the
+actions that depend on any output whose timestamp didn't change.  So a
+generator that leaves an identical output untouched stops a no-op rebuild
+from cascading.  Each output is written to a temporary file next to it and
+renamed into place, so a reader never sees a partial file.
+"""
+
+import json
+import os
+import threading
+
+
+def write_file(path, contents):
+    '''Atomically writes `contents` to the file at `path`, creating its
+       directory if need be, unless the file already holds exactly those
+       contents.  Returns True iff the file was written.'''
+    if not isinstance(contents, bytes):
+        contents = contents.encode('utf-8')
+    try:
+        if os.path.getsize(path) == len(contents):
+            with open(path, 'rb') as file:
+                if file.read() == contents:
+                    return False
+    except OSError:
+        pass
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another action might have just made it.
+            if not os.path.isdir(directory):
+                raise
+    temp_path = os.path.join(directory, '.%s.%d.%d.tmp' % (
+        os.path.basename(path), os.getpid(), threading.current_thread().ident))
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(contents)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
+
+def write_json(path, value):
+    '''Writes `value` as JSON to the file at `path` like write_file, in the
+       indented and key-sorted form the build uses for JSON outputs.'''
+    return write_file(path, json.dumps(value, indent=2, sort_keys=True))
@@ -4,7 +4,6 @@
 # found in the LICENSE file.
 
 import argparse
-import errno
 import os
 import re
 import shutil
@@ -21,6 +20,8 @@ ZIRCON_ROOT = os.path.join(FUCHSIA_ROOT, 'zircon')
 sys.path += [os.path.join(FUCHSIA_ROOT, 'third_party', 'mako')]
 from mako.lookup import TemplateLookup
 from mako.template import Template
+sys.path += [os.path.dirname(SCRIPT_DIR)]
+import write_if_changed
 
 
 # Packages included in the sysroot.
@@ -44,24 +45,15 @@ MANDATORY_SDK_HEADERS = [
 # TODO(ZX-1871): Once everything in Zircon is migrated, remove this mechanism.
 LIBRARIES_BEING_MOVED = [ 'zx' ]
 
+# Subdirectories of the output directory holding the generated files.
+OUTPUT_SUBDIRS = ['config', 'fidl', 'lib', 'sysroot', 'tool']
+
 # Prebuilt libraries for which headers shouldn't be included in an SDK.
 # While this kind of mechanism exists in the GN build, there's no equivalent in
 # the make build and we have to manually curate these libraries.
 LIBRARIES_WITHOUT_SDK_HEADERS = [ 'trace-engine' ]
 
 
-def make_dir(path, is_dir=False):
-    '''Creates the directory at `path`.'''
-    target = path if is_dir else os.path.dirname(path)
-    try:
-        os.makedirs(target)
-    except OSError as exception:
-        if exception.errno == errno.EEXIST and os.path.isdir(target):
-            pass
-        else:
-            raise
-
-
 def try_remove(list, element):
     '''Attempts to remove an element from a list, returning `true` if
        successful.'''
@@ -127,12 +119,28 @@ def filter_deps(deps):
 
 
 def generate_build_file(path, template_name, data, context):
-    '''Creates a build file based on a template.'''
-    make_dir(path)
+    '''Creates a build file based on a template.
+
+       The file is left untouched if its contents are unchanged, so that GN
+       doesn't need to run again.'''
     template = context.templates.get_template(template_name)
     contents = template.render(data=data)
-    with open(path, 'w') as build_file:
-        build_file.write(contents)
+    write_if_changed.write_file(path, contents)
+    context.generated.add(path)
+
+
+def remove_stale_files(out_dir, generated):
+    '''Removes the files in the output subdirectories that weren't generated
+       this time, and any directories left empty.'''
+    for subdir in OUTPUT_SUBDIRS:
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(out_dir, subdir), topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path not in generated:
+                    os.remove(path)
+            if not os.listdir(dirpath):
+                os.rmdir(dirpath)
 
 
 class SourceLibrary(object):
@@ -376,6 +384,7 @@ class GenerationContext(object):
         self.user_build_base = user_build_base
         self.tool_build_base = tool_build_base
         self.templates = templates
+        self.generated = set()
 
 
 def main():
@@ -398,11 +407,6 @@ def main():
     args = parser.parse_args()
 
     out_dir = os.path.abspath(args.out)
-    shutil.rmtree(os.path.join(out_dir, 'config'), True)
-    shutil.rmtree(os.path.join(out_dir, 'fidl'), True)
-    shutil.rmtree(os.path.join(out_dir, 'lib'), True)
-    shutil.rmtree(os.path.join(out_dir, 'sysroot'), True)
-    shutil.rmtree(os.path.join(out_dir, 'tool'), True)
     debug = args.debug
 
     # Generate package descriptions through Zircon's build.
@@ -476,6 +480,8 @@ def main():
         package = parse_package(board_file.readlines())
         generate_board_list(package, context)
 
+    remove_stale_files(out_dir, context.generated)
+
 
 if __name__ == '__main__':
     sys.exit(main())